@@ -0,0 +1,273 @@
+"""End-to-end benchmark of the bridge against simulated cards and a local broker.
+
+For every card mix it measures:
+
+- poll cycle time and CPU per cycle: the bridge module is imported in a child
+  process and every read plan of every card is run back to back,
+- publishes per second and bridge CPU load: the bridge runs as a normal
+  service process with the default schedule,
+- command to readback latency: a command is sent to each output kind in the
+  mix and the time until the matching response topic arrives is recorded.
+
+The simulated drivers from ../sim are put in front of the real ones through
+PYTHONPATH, so no hardware and no external broker are needed:
+
+    python3 bench/benchmark.py
+    python3 bench/benchmark.py megabas full --duration 20 --latency 0.0005
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from broker import Broker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BRIDGE = os.path.join(ROOT, 'sequent-mqtt.py')
+SIM = os.path.join(ROOT, 'sim')
+TOPIC = 'bench'
+
+mixes = {
+    "megaind": ( "megaind", ),
+    "megabas": ( "megabas", ),
+    "mixed": ( "megaind", "megabas", "8relind", "8inputs", "rtd" ),
+    "full": ( "megaind", "megabas", "megabas", "megaind", "8relind", "8relind", "8inputs", "rtd" ),
+    "dualbus": ( "megaind", "megabas", "8relind", "rtd", "megaind@3", "megabas@3", "8relind@3", "rtd@3" ),
+}
+
+# output topic and the two values toggled for the latency test, per card
+commands = {
+    "megaind": ( "0_10/1", "2.5", "7.5" ),
+    "megabas": ( "triac/1", "1", "0" ),
+    "8relind": ( "relay/1", "1", "0" ),
+}
+
+
+def card_places(cards):
+    # "card@bus" entries go to the given bus, stacks are numbered per bus
+    places = []
+    stacks = {}
+    for entry in cards:
+        card, _, bus = entry.partition('@')
+        bus = int(bus or 1)
+        stacks[bus] = stacks.get(bus, -1) + 1
+        places.append(( bus, stacks[bus], card ))
+    return places
+
+
+def card_prefix(bus, stack, card):
+    return TOPIC + '/' + ('' if bus == 1 else 'bus' + str(bus) + '/') + card + '/' + str(stack)
+
+
+def config_write(path, port, cards, args):
+    text = "[MQTT]\nTOPIC = " + TOPIC + "\nSERVER = 127.0.0.1\nPORT = " + str(port) + "\nQOS = 0\nTIMEOUT = 10\nUSER = bench\nPASS = bench\n\n[CARDS]\n"
+    for bus, stack, card in card_places(cards):
+        text += ("" if bus == 1 else "BUS" + str(bus) + "_") + "STACK" + str(stack) + " = " + card + "\n"
+    text += "\n[WATCHDOG]\nTIMEOUT = 120\nBOOT = 300\nRESET = 10\n"
+    text += "\n[HEARTBEAT]\nTIMEOUT = 3600\nTOPIC_CHALLENGE = heartbeat/ping\nTOPIC_RESPONSE = heartbeat/pong\n"
+    text += "\n[SIMULATION]\nLATENCY = " + str(args.latency) + "\nBYTE_TIME = " + str(args.byte_time) + "\n"
+    if args.poll:
+        text += "\n[POLL]\n"
+        for item in args.poll.split(','):
+            text += item.replace('=', ' = ') + "\n"
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def environment():
+    return dict(os.environ, PYTHONPATH=SIM + os.pathsep + os.environ.get('PYTHONPATH', ''), PYTHONUNBUFFERED='1')
+
+
+def cpu_time(pid):
+    # user + system time of a process in seconds from /proc
+    with open('/proc/' + str(pid) + '/stat') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bus_cycle(bridge, stacks, init):
+    for stack in stacks:
+        for plan in bridge.plans[bridge.cards[stack]]:
+            bridge.get_plan(stack, plan, init)
+
+
+def cycle_run(cycles):
+    # runs inside the child process, cwd holds the generated config.ini
+    spec = importlib.util.spec_from_file_location('bridge', BRIDGE)
+    bridge = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bridge)
+    client = mqtt.Client()
+    published = [ 0 ]
+    client.on_publish = lambda client, userdata, mid: published.__setitem__(0, published[0] + 1)
+    client.connect(bridge.config['MQTT']['SERVER'], int(bridge.config['MQTT']['PORT']))
+    client.loop_start()
+    bridge.client = client
+    bridge.layout_init()
+    bridge.filters_init()
+    # the bridge loads card libraries lazily on the bus workers, the cycles below call the drivers directly
+    for stack in bridge.cards:
+        bridge.drivers[stack] = bridge.driver_load(stack, bridge.cards[stack])
+    bridge.worker_start()
+    buses = {}
+    for stack in bridge.cards:
+        buses.setdefault(bridge.card_bus(stack), []).append(stack)
+    bus_cycle(bridge, bridge.cards, 1)
+    time.sleep(0.5)
+    published[0] = 0
+    times = []
+    cpu = []
+    for cycle in range(cycles):
+        wall = time.perf_counter()
+        process = time.process_time()
+        # every bus is polled by its own thread like the bridge workers do
+        threads = [ threading.Thread(target=bus_cycle, args=(bridge, stacks, 0)) for stacks in buses.values() ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        times.append(time.perf_counter() - wall)
+        cpu.append(time.process_time() - process)
+    time.sleep(0.5)
+    client.loop_stop()
+    client.disconnect()
+    print(json.dumps({ "times": times, "cpu": cpu, "published": published[0] }))
+
+
+def cycle_measure(rundir, cycles):
+    result = subprocess.run([ sys.executable, os.path.abspath(__file__), '--cycle', str(cycles) ], cwd=rundir, env=environment(), capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError("cycle run failed:\n" + result.stdout + result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+class Listener:
+    def __init__(self, port):
+        self.count = 0
+        self.online = threading.Event()
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.client = mqtt.Client()
+        self.client.on_message = self.on_message
+        self.client.connect('127.0.0.1', port)
+        self.client.subscribe(TOPIC + '/#')
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        if '/output/' in message.topic:
+            return
+        self.count += 1
+        if message.topic == TOPIC + '/tele/LWT' and message.payload == b'Online':
+            self.online.set()
+        with self.lock:
+            waiter = self.waiting.get(message.topic)
+        if waiter and message.payload.decode('utf-8') == waiter[0]:
+            waiter[1].set()
+
+    def command(self, topic, response, value, timeout=5.0):
+        done = threading.Event()
+        with self.lock:
+            self.waiting[response] = ( value, done )
+        start = time.perf_counter()
+        self.client.publish(topic, value)
+        received = done.wait(timeout)
+        with self.lock:
+            self.waiting.pop(response, None)
+        return time.perf_counter() - start if received else None
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def latency_measure(listener, cards, samples):
+    results = {}
+    for bus, stack, card in card_places(cards):
+        if card not in commands or card in results:
+            continue
+        output, first, second = commands[card]
+        topic = card_prefix(bus, stack, card) + '/output/' + output
+        response = card_prefix(bus, stack, card) + '/response/' + output
+        delays = []
+        for sample in range(samples):
+            delay = listener.command(topic, response, second if sample % 2 else first)
+            if delay is not None:
+                delays.append(delay)
+            time.sleep(0.05)
+        results[card] = delays
+    return results
+
+
+def mix_run(name, cards, args, broker, port):
+    rundir = tempfile.mkdtemp(prefix='sequent-bench-')
+    config_write(os.path.join(rundir, 'config.ini'), port, cards, args)
+    print("== " + name + ": " + ", ".join(cards))
+    cycle = cycle_measure(rundir, args.cycles)
+    print("poll cycle      {:8.2f} ms median {:8.2f} ms p95".format(statistics.median(cycle["times"]) * 1000, percentile(cycle["times"], 0.95) * 1000))
+    print("cpu per cycle   {:8.2f} ms median".format(statistics.median(cycle["cpu"]) * 1000))
+    print("cycle publishes {:8d} in {} cycles".format(cycle["published"], args.cycles))
+    # drop the retained LWT of the previous mix so only this bridge can signal online
+    broker.route(TOPIC + '/tele/LWT', b'', True)
+    listener = Listener(port)
+    process = subprocess.Popen([ sys.executable, BRIDGE ], cwd=rundir, env=environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not listener.online.wait(15):
+            raise RuntimeError("bridge did not come online")
+        time.sleep(args.settle)
+        count = listener.count
+        cpu = cpu_time(process.pid)
+        start = time.monotonic()
+        time.sleep(args.duration)
+        elapsed = time.monotonic() - start
+        cpu = cpu_time(process.pid) - cpu
+        count = listener.count - count
+        print("publishes       {:8.1f} /s".format(count / elapsed))
+        print("bridge cpu      {:8.1f} %".format(cpu / elapsed * 100))
+        for card, delays in latency_measure(listener, cards, args.samples).items():
+            if delays:
+                print("latency {:8s}{:8.2f} ms median {:8.2f} ms p95 ({}/{})".format(card, statistics.median(delays) * 1000, percentile(delays, 0.95) * 1000, len(delays), args.samples))
+            else:
+                print("latency {:8s}     no readback".format(card))
+    finally:
+        process.terminate()
+        process.wait()
+        listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bridge against simulated cards.")
+    parser.add_argument('mixes', nargs='*', default=[ "megaind", "megabas", "mixed", "full", "dualbus" ], help="card mixes to run: " + ", ".join(mixes) + " or a comma separated card list, card@bus places a card on another I2C bus")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of steady state service run")
+    parser.add_argument('--settle', type=float, default=2.0, help="seconds to wait after the bridge came online")
+    parser.add_argument('--cycles', type=int, default=50, help="poll cycles measured in process")
+    parser.add_argument('--samples', type=int, default=20, help="commands sent per output kind")
+    parser.add_argument('--latency', type=float, default=0.0003, help="simulated I2C transaction latency in seconds")
+    parser.add_argument('--byte-time', type=float, default=0.00009, help="simulated I2C time per byte in seconds")
+    parser.add_argument('--poll', help="[POLL] overrides, e.g. DIGITAL=0.05,ANALOG=0.5")
+    parser.add_argument('--cycle', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.cycle:
+        cycle_run(args.cycle)
+        return
+    broker = Broker()
+    port = broker.start()
+    for name in args.mixes:
+        mix_run(name, mixes.get(name) or tuple(name.split(',')), args, broker, port)
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
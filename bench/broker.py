@@ -0,0 +1,199 @@
+"""Minimal in-process MQTT 3.1.1 broker used as a local stand-in by the benchmarks.
+
+It implements just enough of the protocol for the bridge and the benchmark
+clients: CONNECT with will, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards,
+PUBLISH at QoS 0, 1 and 2, retained messages and PINGREQ. Delivery to
+subscribers is always done at QoS 0, which keeps the broker overhead out of
+the measured numbers.
+"""
+
+import asyncio
+import struct
+import threading
+
+
+def topic_match(pattern, topic):
+    patterns = pattern.split('/')
+    topics = topic.split('/')
+    for i, part in enumerate(patterns):
+        if part == '#':
+            return True
+        if i >= len(topics) or (part != '+' and part != topics[i]):
+            return False
+    return len(patterns) == len(topics)
+
+
+def encode_length(length):
+    result = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        result.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(result)
+
+
+def encode_string(value):
+    return struct.pack('!H', len(value)) + value
+
+
+class Session:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = {}
+        self.will = None
+
+    def send(self, packet_type, body):
+        self.writer.write(bytes([ packet_type ]) + encode_length(len(body)) + body)
+
+    def deliver(self, topic, payload, retain=False):
+        self.send(0x30 | (1 if retain else 0), encode_string(topic) + payload)
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0], await self.reader.readexactly(length)
+
+    async def run(self):
+        clean = False
+        try:
+            while True:
+                header, body = await self.read_packet()
+                kind = header >> 4
+                if kind == 1:
+                    self.connect(body)
+                elif kind == 3:
+                    self.publish(header, body)
+                elif kind == 6:
+                    self.send(0x70, body[0:2])
+                elif kind == 8:
+                    self.subscribe(body)
+                elif kind == 10:
+                    self.unsubscribe(body)
+                elif kind == 12:
+                    self.send(0xd0, b'')
+                elif kind == 14:
+                    clean = True
+                    break
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.sessions.discard(self)
+            if not clean and self.will:
+                self.broker.route(*self.will)
+            self.writer.close()
+
+    def connect(self, body):
+        offset = 2 + struct.unpack('!H', body[0:2])[0]
+        flags = body[offset + 1]
+        offset += 4
+        length = struct.unpack('!H', body[offset:offset + 2])[0]
+        offset += 2 + length
+        if flags & 0x04:
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            topic = body[offset + 2:offset + 2 + length].decode('utf-8')
+            offset += 2 + length
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            payload = body[offset + 2:offset + 2 + length]
+            self.will = ( topic, payload, bool(flags & 0x20) )
+        self.send(0x20, b'\x00\x00')
+
+    def publish(self, header, body):
+        qos = (header >> 1) & 0x03
+        length = struct.unpack('!H', body[0:2])[0]
+        topic = body[2:2 + length].decode('utf-8')
+        offset = 2 + length
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            self.send(0x40 if qos == 1 else 0x50, packet_id)
+        self.broker.route(topic, body[offset:], bool(header & 0x01))
+
+    def subscribe(self, body):
+        offset = 2
+        codes = bytearray()
+        while offset < len(body):
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            pattern = body[offset + 2:offset + 2 + length].decode('utf-8')
+            qos = body[offset + 2 + length]
+            offset += 3 + length
+            self.subscriptions[pattern] = qos
+            codes.append(min(qos, 2))
+            for topic, payload in list(self.broker.retained.items()):
+                if topic_match(pattern, topic):
+                    self.deliver(topic.encode('utf-8'), payload, True)
+        self.send(0x90, body[0:2] + bytes(codes))
+
+    def unsubscribe(self, body):
+        offset = 2
+        while offset < len(body):
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            self.subscriptions.pop(body[offset + 2:offset + 2 + length].decode('utf-8'), None)
+            offset += 2 + length
+        self.send(0xb0, body[0:2])
+
+
+class Broker:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.sessions = set()
+        self.retained = {}
+        self.messages = 0
+        self.loop = None
+        self.server = None
+
+    def route(self, topic, payload, retain=False):
+        self.messages += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        encoded = topic.encode('utf-8')
+        for session in list(self.sessions):
+            for pattern in session.subscriptions:
+                if topic_match(pattern, topic):
+                    session.deliver(encoded, payload)
+                    break
+
+    async def handle(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        await session.run()
+
+    def start(self):
+        # run the broker event loop in a daemon thread, returns the bound port
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self.port
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+if __name__ == '__main__':
+    import sys
+    broker = Broker(port=int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+    print('MQTT broker stand-in listening on port ' + str(broker.start()))
+    threading.Event().wait()
@@ -0,0 +1,144 @@
+"""Minimal Modbus TCP client to check and load test the bridge Modbus server.
+
+Reads and writes use the function codes the bridge serves: 1 coils,
+2 discrete inputs, 3 holding and 4 input registers, 5 and 15 for coils and
+16 for holding registers. Register pairs are shown as float32 or, with
+--uint, as uint32, high word first like the bridge sends them:
+
+    python3 bench/modbus.py read 1 input 0 8
+    python3 bench/modbus.py write 3 coils 2 1
+    python3 bench/modbus.py write 1 holding 2 3.5
+    python3 bench/modbus.py poll 1 input 0 24 --clients 20 --rate 10 --duration 10
+"""
+
+import argparse
+import socket
+import statistics
+import struct
+import threading
+import time
+
+FUNCTIONS = { "coils": 1, "discrete": 2, "holding": 3, "input": 4 }
+
+
+class Client:
+    def __init__(self, host, port):
+        self.sock = socket.create_connection(( host, port ))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transaction = 0
+
+    def request(self, unit, pdu):
+        self.transaction = (self.transaction + 1) & 0xffff
+        self.sock.sendall(struct.pack('>HHHB', self.transaction, 0, len(pdu) + 1, unit) + pdu)
+        header = self.receive(7)
+        transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+        reply = self.receive(length - 1)
+        if transaction != self.transaction:
+            raise ValueError("transaction mismatch")
+        if reply[0] & 0x80:
+            raise ValueError("exception code " + str(reply[1]))
+        return reply
+
+    def receive(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data += chunk
+        return data
+
+    def read(self, unit, kind, start, count):
+        reply = self.request(unit, struct.pack('>BHH', FUNCTIONS[kind], start, count))
+        data = reply[2:]
+        if kind in ( "coils", "discrete" ):
+            return [ data[index // 8] >> (index % 8) & 1 for index in range(count) ]
+        return list(struct.unpack('>' + str(count) + 'H', data))
+
+    def write_coils(self, unit, start, values):
+        if len(values) == 1:
+            return self.request(unit, struct.pack('>BHH', 5, start, 0xff00 if values[0] else 0))
+        data = bytearray((len(values) + 7) // 8)
+        for index, value in enumerate(values):
+            if value:
+                data[index // 8] |= 1 << (index % 8)
+        return self.request(unit, struct.pack('>BHHB', 15, start, len(values), len(data)) + data)
+
+    def write_floats(self, unit, start, values):
+        data = b''.join(struct.pack('>f', value) for value in values)
+        return self.request(unit, struct.pack('>BHHB', 16, start, len(values) * 2, len(data)) + data)
+
+
+def pairs(words, code):
+    return [ struct.unpack(code, struct.pack('>HH', words[i], words[i + 1]))[0] for i in range(0, len(words) - 1, 2) ]
+
+
+def poll(args):
+    # CLIENTS connections each reading the same block RATE times a second, reports request latency
+    latencies = []
+    errors = [ 0 ]
+    lock = threading.Lock()
+    end = time.monotonic() + args.duration
+
+    def run():
+        client = Client(args.host, args.port)
+        deadline = time.monotonic()
+        local = []
+        while deadline < end:
+            start = time.perf_counter()
+            try:
+                client.read(args.unit, args.kind, args.start, args.count)
+                local.append(time.perf_counter() - start)
+            except ValueError:
+                errors[0] += 1
+            deadline += 1 / args.rate
+            time.sleep(max(0, deadline - time.monotonic()))
+        with lock:
+            latencies.extend(local)
+
+    threads = [ threading.Thread(target=run) for _ in range(args.clients) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    print("requests         ", len(latencies), "ok,", errors[0], "errors in", args.duration, "s")
+    print("requests/s       ", round(len(latencies) / args.duration, 1))
+    print("latency median   ", round(statistics.median(latencies) * 1000, 3), "ms")
+    print("latency p99      ", round(latencies[int(len(latencies) * 0.99)] * 1000, 3), "ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=( "read", "write", "poll" ))
+    parser.add_argument('unit', type=int)
+    parser.add_argument('kind', choices=tuple(FUNCTIONS))
+    parser.add_argument('start', type=int)
+    parser.add_argument('values', nargs='*', help="count to read or values to write")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=502)
+    parser.add_argument('--uint', action='store_true', help="show register pairs as uint32")
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=10)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+    args.count = int(args.values[0]) if args.values and args.action != "write" else 1
+    if args.action == "poll":
+        poll(args)
+        return
+    client = Client(args.host, args.port)
+    if args.action == "read":
+        values = client.read(args.unit, args.kind, args.start, args.count)
+        if args.kind in ( "holding", "input" ):
+            values = pairs(values, '>I' if args.uint else '>f')
+        print(values)
+    elif args.kind == "coils":
+        client.write_coils(args.unit, args.start, [ int(value) for value in args.values ])
+    elif args.kind == "holding":
+        client.write_floats(args.unit, args.start, [ float(value) for value in args.values ])
+    else:
+        parser.error("only coils and holding registers are writable")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,563 +2,2504 @@
 
 import paho.mqtt.client as mqtt
 import configparser
+import array
+import asyncio
+import bisect
+import collections
 import operator
+import heapq
+import importlib.util
+import itertools
+import math
+import mmap
+import os
+import queue
+import threading
+import http.server
 import json
 import time
 import uptime
 import datetime
 import re
+import signal
+import struct
+import socket
 import sys
+import types
+import smbus2
+import socketserver
+import sqlite3
 
 # define user-defined exception
 class AppError(Exception):
     "Raised on application error"
     pass
 
-# global variables
+# global variables, cards are keyed by ( bus, stack )
+process_start = time.monotonic()
 cards = {}
+drivers = {}
+driver_copies = {}
+libraries = { "megaind": "megaind", "megabas": "megabas", "8relind": "lib8relind", "8inputs": "lib8inputs", "rtd": "librtd" }
 tele = {}
-cache = [ {}, {}, {}, {}, {}, {}, {}, {} ]
-
-# read config
-config = configparser.ConfigParser()
-config.read('config.ini')
-if 'MQTT' in config:
-    for key in ['TOPIC', 'SERVER', 'PORT', 'QOS', 'TIMEOUT', 'USER', 'PASS']:
-        if not config['MQTT'][key]:
-            raise AppError("Missing or empty config entry MQTT/" + key)
-else:
-    raise AppError("Missing config section MQTT")  
-
-if 'CARDS' in config:
+schedule = []
+schedule_sequence = itertools.count()
+routes = {}
+workers = {}
+worker_sequence = itertools.count()
+wake = None
+wake_loop = None
+client = None
+
+# flat channel state, one slot per channel of every configured card
+cache = array.array('d')
+integers = array.array('b')
+topics = []
+slots = {}
+bindings = {}
+slot_stacks = []
+slot_keys = []
+
+# per card JSON state documents, changed slots since the last document
+state_topics = {}
+changes = {}
+
+# slots whose publish failed while the broker was away, cache survives reconnects once synced
+unsent = set()
+synced = False
+
+# output write modes per ( stack, output ), optimistic writes waiting for verification per slot,
+# fire writes whose next read-back goes out even when it matches the commanded value in the cache
+write_modes = {}
+expected = {}
+readback = set()
+
+# analog input filters, settings and smoothing state per slot, filtered banks by first slot
+filters = {}
+filtered = set()
+smoothing = {}
+published_at = array.array('d')
+
+# sample history per recorded slot: [ values, times, next index, count ], fixed size ring buffers
+history = {}
+recorded = set()
+summarized = set()
+summaries = {}
+history_lock = threading.Lock()
+
+# derived pulse rates per counter slot: [ scale, last count, last read time, pulses, interval start ], slots publishing the rate only
+rates = {}
+rated = set()
+rate_only = set()
+rate_groups = {}
+rate_lock = threading.Lock()
+counter_bits = { "opto_count": 16, "cont_count": 32 }
+
+# store and forward journal of changes while the broker is away, journaled slots by signal class opt-in
+journal = None
+journaled = set()
+journal_lock = threading.Lock()
+journal_draining = threading.Event()
+journal_inserts = itertools.count(1)
+
+# shared memory export of the cache, layout documented in sequent_shared.py
+EXPORT_MAGIC = b'SQMQ'
+EXPORT_VERSION = 1
+EXPORT_HEADER = struct.Struct('<4sHHIIIIIIIId')
+EXPORT_HEADER_SIZE = 64
+EXPORT_RECORD = struct.Struct('<IIdd')
+EXPORT_NAME_SIZE = 96
+EXPORT_MOVED = 0xffffffff
+export_map = None
+export_capacity = 0
+export_generation = 0
+export_sequences = array.array('I')
+export_lock = threading.Lock()
+
+# hot path metrics: timing per card and function, poll cycles per card and signal class, event counters
+METRIC_BUCKETS = ( 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0 )
+timings = {}
+cycles = {}
+counters = collections.Counter()
+metrics_lock = threading.Lock()
+
+# card health readings per stack: ( expiry, values )
+health = {}
+# master cards whose health read for tele/STATE is still queued
+tele_waiting = set()
+tele_lock = threading.Lock()
+
+# degraded cards, consecutive failures and next retry time per stack
+degraded = {}
+
+# read plans of a started or added card not read yet, rules on its channels wait for all of them
+unread = {}
+
+# startup phases in seconds since process start, read plans of the first snapshot still running per card
+startup = { "cards": {} }
+snapshot_waiting = {}
+snapshot_lock = threading.Lock()
+
+# Modbus TCP unit tables per unit id, swapped in whole on a config reload
+modbus_units = {}
+
+# rules from the RULES section, the rules reading each slot, compiled anew on a config reload
+rules = []
+ruled = {}
+rules_lock = threading.Lock()
+RULE_TOKENS = re.compile(r'\s*(->|>=|<=|==|!=|[()<>~,=]|[^\s()<>=!~,]+)')
+RULE_OPERATORS = { '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq, '!=': operator.ne }
+
+# safety thread: stacks with a watchdog reload still queued, heartbeat loss to be raised in the main loop
+safety_pending = set()
+safety_error = None
+
+# bus worker queue priorities, output commands jump ahead of periodic reads, safety actions ahead of commands,
+# a card library loads before all
+PRIORITY_LOAD = -2
+PRIORITY_SAFETY = -1
+PRIORITY_COMMAND = 0
+PRIORITY_HEALTH = 1
+PRIORITY_POLL = 2
+
+def setting(config, section, key, kind, default=None):
+    # one typed config entry, a missing entry without default is an error
+    if section not in config or not config[section].get(key, raw=True):
+        if default is None:
+            raise AppError("Missing or empty config entry " + section + "/" + key)
+        return default
+    try:
+        return kind(config[section].get(key, raw=True))
+    except ValueError:
+        raise AppError("Invalid config entry " + section + "/" + key + ": " + config[section].get(key, raw=True))
+
+
+def setting_boolean(value):
+    if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+        raise ValueError(value)
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
+def setting_choice(config, section, key, choices):
+    value = setting(config, section, key, str, choices[0])
+    if value not in choices:
+        raise AppError("Invalid config entry " + section + "/" + key + ", use " + ", ".join(choices[:-1]) + " or " + choices[-1])
+    return value
+
+
+def settings_parse(config):
+    # validate the whole config and convert every scalar entry once, sections of per channel entries
+    # (FILTER, HISTORY, RATE, OUTPUT modes) are parsed by their init functions
+    for section in ( 'MQTT', 'CARDS', 'WATCHDOG', 'HEARTBEAT' ):
+        if section not in config:
+            raise AppError("Missing config section " + section)
+    result = {
+        "topic": setting(config, 'MQTT', 'TOPIC', str),
+        "server": setting(config, 'MQTT', 'SERVER', str),
+        "port": setting(config, 'MQTT', 'PORT', int),
+        "qos": setting(config, 'MQTT', 'QOS', int),
+        "timeout": setting(config, 'MQTT', 'TIMEOUT', int),
+        "user": setting(config, 'MQTT', 'USER', str),
+        "pass": setting(config, 'MQTT', 'PASS', str),
+        "client_id": setting(config, 'MQTT', 'CLIENT_ID', str, ''),
+        "state": setting_choice(config, 'MQTT', 'STATE', [ 'channel', 'json', 'both' ]),
+        "retain": setting(config, 'MQTT', 'RETAIN', setting_boolean, False),
+        "session": setting_choice(config, 'MQTT', 'SESSION', [ 'clean', 'persistent' ]),
+        "tele_masters": setting_choice(config, 'MQTT', 'TELE_MASTERS', [ 'first', 'all' ]),
+        "runtime": setting_choice(config, 'MQTT', 'RUNTIME', [ 'thread', 'asyncio' ]),
+        "cards": {},
+        "watchdog_timeout": setting(config, 'WATCHDOG', 'TIMEOUT', int),
+        "watchdog_boot": setting(config, 'WATCHDOG', 'BOOT', int),
+        "watchdog_reset": setting(config, 'WATCHDOG', 'RESET', int),
+        "watchdog_deadline": setting(config, 'WATCHDOG', 'DEADLINE', float, 1.0),
+        "watchdog_realtime": setting(config, 'WATCHDOG', 'REALTIME', int, 0),
+        "heartbeat_timeout": setting(config, 'HEARTBEAT', 'TIMEOUT', int),
+        "heartbeat_challenge": setting(config, 'HEARTBEAT', 'TOPIC_CHALLENGE', str),
+        "heartbeat_response": setting(config, 'HEARTBEAT', 'TOPIC_RESPONSE', str),
+        "poll": {},
+        "coalesce": setting(config, 'OUTPUT', 'COALESCE', float, 0.0),
+        "metrics_interval": setting(config, 'METRICS', 'INTERVAL', float, 0.0),
+        "metrics_port": setting(config, 'METRICS', 'PORT', int, 0),
+        "metrics_bind": setting(config, 'METRICS', 'BIND', str, '127.0.0.1'),
+        "modbus_port": setting(config, 'MODBUS', 'PORT', int, 0),
+        "modbus_bind": setting(config, 'MODBUS', 'BIND', str, '127.0.0.1'),
+        "journal_path": setting(config, 'JOURNAL', 'PATH', str, ''),
+        "journal_classes": [ signal_class.strip() for signal_class in setting(config, 'JOURNAL', 'CLASSES', str, 'digital,counter').split(',') ],
+        "journal_retention": setting(config, 'JOURNAL', 'RETENTION', float, 86400.0),
+        "journal_size": setting(config, 'JOURNAL', 'SIZE', int, 100000),
+        "journal_rate": setting(config, 'JOURNAL', 'RATE', float, 100.0),
+        "shared_path": setting(config, 'SHARED', 'PATH', str, ''),
+    }
+    if result["session"] == 'persistent' and not result["client_id"]:
+        raise AppError("Missing config entry MQTT/CLIENT_ID, required by persistent session")
     for key in config['CARDS']:
         if config['CARDS'][key]:
-            match = re.match(r'^STACK([0-7])$', key, re.IGNORECASE)
+            match = re.match(r'^(?:BUS(\d+)_)?STACK([0-7])$', key, re.IGNORECASE)
             if match:
-                cards[int(match.group(1))] = config['CARDS'][key]
-    if not len(cards):
+                if config['CARDS'][key] not in libraries:
+                    raise AppError("Uknown card type " + config['CARDS'][key])
+                result["cards"][(int(match.group(1) or 1), int(match.group(2)))] = config['CARDS'][key]
+    if not len(result["cards"]):
         raise AppError("Missing config section CARDS")
-else:
-    raise AppError("Missing config section CARDS")
-
-if 'WATCHDOG' in config:
-    for key in ['TIMEOUT', 'BOOT', 'RESET']:
-        if not config['WATCHDOG'][key]:
-            raise AppError("Missing or empty config entry WATCHDOG/" + key)
-else:
-    raise AppError("Missing config section WATCHDOG")
-
-if 'HEARTBEAT' in config:
-    for key in ['TIMEOUT', 'TOPIC_CHALLENGE', 'TOPIC_RESPONSE']:
-        if not config['HEARTBEAT'][key]:
-            raise AppError("Missing or empty config entry HEARTBEAT/" + key)
-else:
-    raise AppError("Missing config section HEARTBEAT")
-
-
-for stack in cards.keys():
-    if cards[stack] == "megaind":
+    # POLL holds intervals only: signal classes, STACKn_/BUSm_STACKn_ overrides, TELE, HEALTH, RETRY and RETRY_MAX
+    if 'POLL' in config:
+        for key in config['POLL']:
+            if config['POLL'][key]:
+                result["poll"][key.upper()] = setting(config, 'POLL', key, float)
+                # a zero interval would spin the scheduler, its skipped cycle count divides by it
+                if result["poll"][key.upper()] <= 0:
+                    raise AppError("Invalid config entry POLL/" + key.upper() + ", use an interval above 0")
+    if result["journal_rate"] <= 0:
+        raise AppError("Invalid config entry JOURNAL/RATE, use a rate above 0")
+    return result
+
+
+def settings_globals():
+    # shortcuts of the settings used on every publish
+    global qos, retain, state_mode, session, health_ttl, tele_masters, coalesce, runtime
+    qos = settings["qos"]
+    retain = settings["retain"]
+    state_mode = settings["state"]
+    session = settings["session"]
+    health_ttl = settings["poll"].get('HEALTH', 60.0)
+    tele_masters = settings["tele_masters"]
+    coalesce = settings["coalesce"]
+    runtime = settings["runtime"]
+
+
+# read config
+config_path = 'config.ini'
+config = configparser.ConfigParser()
+config.read(config_path)
+settings = settings_parse(config)
+settings_globals()
+cards.update(settings["cards"])
+startup_config = round(time.monotonic() - process_start, 3)
+reload_pending = False
+
+
+class BusPinned:
+    "Stands in for the smbus module of a driver copy, every handle opens the pinned bus"
+
+    def __init__(self, module, bus):
+        self.module = module
+        self.bus = bus
+
+    def SMBus(self, *args, **kwargs):
+        return self.module.SMBus(self.bus)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+def driver_copy(name, bus):
+    # the card libraries talk to bus 1, cards on other buses get a private copy of the library
+    # with BUS_NO and the smbus module pinned to their bus
+    if bus == 1:
+        return sys.modules[name]
+    if (name, bus) not in driver_copies:
+        spec = importlib.util.find_spec(name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if hasattr(module, 'BUS_NO'):
+            module.BUS_NO = bus
+        for key, value in list(vars(module).items()):
+            if isinstance(value, types.ModuleType) and value.__name__ in [ 'smbus', 'smbus2' ]:
+                setattr(module, key, BusPinned(value, bus))
+            elif isinstance(value, type) and value.__name__ == 'SMBus':
+                setattr(module, key, BusPinned(sys.modules[value.__module__], bus).SMBus)
+        driver_copies[(name, bus)] = module
+    return driver_copies[(name, bus)]
+
+
+def driver_load(stack, card):
+    global megaind, megabas, lib8relind, lib8inputs, librtd
+    if card == "megaind":
         try:
             import megaind
         except ImportError:
             raise AppError("Can't import megaind library, is it installed?")
-        else:
-            cache[stack] = { "response": { "0_10": [ 0, 0, 0, 0 ], "4_20": [ 0, 0, 0, 0 ], "pwm": [ 0, 0, 0, 0 ], "led": [ 0, 0, 0, 0 ], "opto_rce": [ 0, 0, 0, 0 ], "opto_fce": [ 0, 0, 0, 0 ]}, "input": { "0_10": [ 0, 0, 0, 0 ], "pm0_10": [ 0, 0, 0, 0 ], "4_20": [ 0, 0, 0, 0 ], "opto": [ 0, 0, 0, 0 ], "opto_count": [ 0, 0, 0, 0 ] } }
-    elif cards[stack] == "megabas":
+    elif card == "megabas":
         try:
             import megabas
         except ImportError:
             raise AppError("Can't import megabas library, is it installed?")
-        else:
-            cache[stack] = { "response": { "0_10": [ 0, 0, 0, 0 ], "triac": [ 0, 0, 0, 0 ], "cont_rce": [ 0, 0, 0, 0, 0, 0, 0, 0 ], "cont_fce": [ 0, 0, 0, 0, 0, 0, 0, 0 ] }, "input": { "0_10": [ 0, 0, 0, 0, 0, 0, 0, 0 ], "1k": [ 0, 0, 0, 0, 0, 0, 0, 0  ], "10k": [ 0, 0, 0, 0, 0, 0, 0, 0  ], "cont": [ 0, 0, 0, 0, 0, 0, 0, 0  ], "cont_count": [ 0, 0, 0, 0, 0, 0, 0, 0  ] } }
-    elif cards[stack] == "8relind":
+    elif card == "8relind":
         try:
             import lib8relind
         except ImportError:
             raise AppError("Can't import lib8relind library, is it installed?")
-        else:
-            cache[stack] = { "response": { "relay": [ 0, 0, 0, 0, 0, 0, 0, 0 ] } }
-    elif cards[stack] == "8inputs":
+    elif card == "8inputs":
         try:
             import lib8inputs
         except ImportError:
             raise AppError("Can't import lib8inputs library, is it installed?")
-        else:
-            cache[stack] = { "input": { "opto": [ 0, 0, 0, 0, 0, 0, 0, 0 ] } }
-    elif cards[stack] == "rtd":
+    elif card == "rtd":
         try:
             import librtd
         except ImportError:
             raise AppError("Can't import librtd library, is it installed?")
-        else:
-            cache[stack] = { "input": { "rtd": [ 0, 0, 0, 0, 0, 0, 0, 0 ] } }
-    else:
-        print("Uknown card type " + cards[stack])
-        raise AppError("Uknown card type " + cards[stack])
+    return driver_copy(libraries[card], stack[0])
 
 
-def get_megaind(stack, init):
-    for channel in range(1,5):
-        value = megaind.get0_10Out(stack, channel)
-        if init or value != cache[stack]["response"]["0_10"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["0_10"][channel - 1] = value
-
-        value = megaind.get4_20Out(stack, channel)
-        if init or value != cache[stack]["response"]["4_20"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/4_20/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["4_20"][channel - 1] = value
-
-        value = megaind.getOdPWM(stack, channel)
-        if init or value != cache[stack]["response"]["pwm"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/pwm/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["pwm"][channel - 1] = value
-
-        value = megaind.getLed(stack, channel)
-        if init or value != cache[stack]["response"]["led"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/led/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["led"][channel - 1] = value
-
-        value = megaind.getOptoRisingCountEnable(stack, channel)
-        if init or value != cache[stack]["response"]["opto_rce"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/opto_rce/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["opto_rce"][channel - 1] = value
-
-        value = megaind.getOptoFallingCountEnable(stack, channel)
-        if init or value != cache[stack]["response"]["opto_fce"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/opto_fce/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["opto_fce"][channel - 1] = value
-
-        value = round(megaind.get0_10In(stack, channel), 2)
-        if init or value != cache[stack]["input"]["0_10"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/input/0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["0_10"][channel - 1] = value
-
-        value = round(megaind.getpm10In(stack, channel), 2)
-        if init or value != cache[stack]["input"]["pm0_10"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/input/pm0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["pm0_10"][channel - 1] = value
-
-        value = megaind.get4_20In(stack, channel)
-        if init or value != cache[stack]["input"]["4_20"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/input/4_20/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["4_20"][channel - 1] = value
-
-        value = megaind.getOptoCh(stack, channel)
-        if init or value != cache[stack]["input"]["opto"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/input/opto/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["opto"][channel - 1] = value
-
-        value = megaind.getOptoCount(stack, channel)
-        if init or value != cache[stack]["input"]["opto_count"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/input/opto_count/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["opto_count"][channel - 1] = value
+def card_load(stack):
+    # libraries are imported by the bus worker right before the first I/O of the card, all buses in parallel
+    if stack not in drivers:
+        drivers[stack] = driver_load(stack, cards[stack])
+
+
+for card in set(cards.values()):
+    # only check the libraries are there, importing them is left to the bus workers
+    if importlib.util.find_spec(libraries[card]) is None:
+        raise AppError("Can't import " + libraries[card] + " library, is it installed?")
+
+
+def read_registers(bus, address, spans):
+    # read all register spans in as few block transfers as possible, SMBus block is max 32 bytes
+    start = min(register for register, length in spans)
+    end = max(register + length for register, length in spans)
+    data = []
+    i2c = smbus2.SMBus(bus)
+    try:
+        for register in range(start, end, 32):
+            data += i2c.read_i2c_block_data(address, register, min(32, end - register))
+    finally:
+        i2c.close()
+    return [ data[register - start:register - start + length] for register, length in spans ]
+
+
+def words(data, signed=False):
+    result = []
+    for i in range(0, len(data), 2):
+        value = data[i] + (data[i + 1] << 8)
+        if signed and value > 32768:
+            value -= 65536
+        result.append(value)
+    return result
+
+
+def bits(mask, count):
+    return [ (mask >> i) & 1 for i in range(count) ]
+
+
+def read_megaind_outputs(stack):
+    out0_10, out4_20, pwm = read_registers(stack[0], megaind.checkStack(stack[1]), ( (megaind.U_0_10_OUT_VAL1_ADD, 8), (megaind.I4_20_OUT_VAL1_ADD, 8), (megaind.I2C_MEM_OD_PWM1, 8) ))
+    return ( [ value / 1000.0 for value in words(out0_10) ], [ value / 1000.0 for value in words(out4_20) ], [ value / 100.0 for value in words(pwm) ] )
+
+
+def read_megaind_digital(stack):
+    relays, optos = read_registers(stack[0], megaind.checkStack(stack[1]), ( (megaind.I2C_MEM_RELAY_VAL, 1), (megaind.I2C_MEM_OPTO_IN_VAL, 1) ))
+    return ( bits(relays[0] >> 4, 4), bits(optos[0], 4) )
+
+
+def read_megaind_counters(stack):
+    rising, falling, counts = read_registers(stack[0], megaind.checkStack(stack[1]), ( (megaind.I2C_MEM_OPTO_RISING_ENABLE, 1), (megaind.I2C_MEM_OPTO_FALLING_ENABLE, 1), (megaind.I2C_MEM_OPTO_COUNT1, 8) ))
+    return ( bits(rising[0], 4), bits(falling[0], 4), words(counts) )
+
+
+def read_megaind_analog(stack):
+    in0_10, inpm0_10, in4_20 = read_registers(stack[0], megaind.checkStack(stack[1]), ( (megaind.U0_10_IN_VAL1_ADD, 8), (megaind.U_PM_10_IN_VAL1_ADD, 8), (megaind.I4_20_IN_VAL1_ADD, 8) ))
+    return ( [ round(value / 1000.0, 2) for value in words(in0_10) ], [ round(value / 1000.0 - 10, 2) for value in words(inpm0_10) ], [ value / 1000.0 for value in words(in4_20) ] )
 
 
 def set_megaind(stack, output, channel, value):
     if output == "0_10" and 1 <= channel <= 4 and 0 <= value <= 10:
         try:
-            megaind.set0_10Out(stack, channel, value)
-            value == megaind.get0_10Out(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].set0_10Out(stack[1], channel, value)
+            if write_modes[(stack, "0_10")] == "verified":
+                value = drivers[stack].get0_10Out(stack[1], channel)
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", response: 0_10, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", response: 0_10, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["0_10"][channel - 1] = value
+            publish_write(stack, "0_10", channel, value)
     elif output == "4_20" and 1 <= channel <= 4 and 4 <= value <= 20:
         try:
-            megaind.set4_20Out(stack, channel, value)
-            value == megaind.get0_10Out(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/4_20/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].set4_20Out(stack[1], channel, value)
+            if write_modes[(stack, "4_20")] == "verified":
+                value = drivers[stack].get4_20Out(stack[1], channel)
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", response: 4_20, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", response: 4_20, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["4_20"][channel - 1] = value
+            publish_write(stack, "4_20", channel, value)
     elif output == "pwm" and 1 <= channel <= 4 and 0 <= value <= 100:
         try:
-            megaind.setOdPWM(stack, channel, value)
-            value = megaind.getOdPWM(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/pwm/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].setOdPWM(stack[1], channel, value)
+            if write_modes[(stack, "pwm")] == "verified":
+                value = drivers[stack].getOdPWM(stack[1], channel)
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", response: pwm, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", response: pwm, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["pwm"][channel - 1] = value
+            publish_write(stack, "pwm", channel, value)
     elif output == "led" and 1 <= channel <= 4 and value in [0, 1]:
         try:
-            megaind.setLed(stack, channel, value)
-            value = megaind.getLed(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/led/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].setLed(stack[1], channel, value)
+            if write_modes[(stack, "led")] == "verified":
+                value = drivers[stack].getLed(stack[1], channel)
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", response: led, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", response: led, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["led"][channel - 1] = value
+            publish_write(stack, "led", channel, value)
     elif output == "opto_rce" and 1 <= channel <= 4 and value in [0, 1]:
         try:
-            megaind.setOptoRisingCountEnable(stack, channel, value)
-            value = megaind.getOptoRisingCountEnable(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/opto_rce/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].setOptoRisingCountEnable(stack[1], channel, value)
+            if write_modes[(stack, "opto_rce")] == "verified":
+                value = drivers[stack].getOptoRisingCountEnable(stack[1], channel)
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", response: opto_rce, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", response: opto_rce, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["opto_rce"][channel - 1] = value
+            publish_write(stack, "opto_rce", channel, value)
     elif output == "opto_fce" and 1 <= channel <= 4 and value in [0, 1]:
         try:
-            megaind.setOptoFallingCountEnable(stack, channel, value)
-            value = megaind.getOptoFallingCountEnable(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/opto_fce/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].setOptoFallingCountEnable(stack[1], channel, value)
+            if write_modes[(stack, "opto_fce")] == "verified":
+                value = drivers[stack].getOptoFallingCountEnable(stack[1], channel)
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", response: opto_fce, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", response: opto_fce, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["opto_fce"][channel - 1] = value
+            publish_write(stack, "opto_fce", channel, value)
     elif output == "opto_rst"  and 1 <= channel <= 4 and value == 1:
         try:
-            megaind.rstOptoCount(stack, channel)
-            value = megaind.getOptoCount(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/response/opto_rst/' + str(channel), 1, int(config['MQTT']['QOS']))
-            client.publish(config['MQTT']['TOPIC'] + '/megaind/' + str(stack) + '/input/opto_count/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            if card_slot(stack, "input", "opto_count", channel) in rates:
+                # take the pulses counted since the last poll into the rate before they are cleared
+                rate_record(card_slot(stack, "input", "opto_count", channel), [ drivers[stack].getOptoCount(stack[1], channel) ], time.monotonic())
+            drivers[stack].rstOptoCount(stack[1], channel)
+            value = drivers[stack].getOptoCount(stack[1], channel)
+            client.publish(settings["topic"] + '/' + card_label(stack) + '/response/opto_rst/' + str(channel), 1, qos)
+            metric_count('publish/response')
         except:
-            raise AppError("Can't set megaind stack: " + str(stack) + ", output: opto_rst, channel: " + str(channel) + " to value: 1")
+            raise AppError("Can't set megaind stack: " + card_stack(stack) + ", output: opto_rst, channel: " + str(channel) + " to value: 1")
         else:
-            cache[stack]["input"]["opto_count"][channel - 1] = value
+            rate_reset(card_slot(stack, "input", "opto_count", channel), value)
+            publish_command(stack, card_slot(stack, "input", "opto_count", channel), value)
     else:
-        raise AppError("Can't set megaind stack: " + str(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
+        raise AppError("Can't set megaind stack: " + card_stack(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
 
 
 def reset_megaind(stack):
+    # every output is tried even when one fails, 4_20 goes to its minimum of 4 mA
+    failed = []
     for channel in range(1,5):
-        for output in ( '4_20', '0_10', 'pwm', 'led' ):
-            set_megaind(stack, output, channel, 0)
-
-
-def tele_megaind(stack):
-    if megaind.getPowerVolt(stack) < 5:
-        return False
-    tele["master"] = "megaind" + str(stack)
-    tele["fw"] = megaind.getFwVer(stack)
-    tele["power_in"] = megaind.getPowerVolt(stack)
-    tele["power_rsp"] = megaind.getRaspVolt(stack)
-    tele["cpu_temp"] = megaind.getCpuTemp(stack)
-    tele["wtd_resets"] = megaind.wdtGetResetCount(stack)
-    return True
+        for output, value in ( ( '4_20', 4 ), ( '0_10', 0 ), ( 'pwm', 0 ) ):
+            try:
+                set_megaind(stack, output, channel, value)
+            except AppError as error:
+                failed.append(str(error))
+    write_bank(stack, 'led', dict.fromkeys(range(1, 5), 0))
+    if failed:
+        raise AppError("; ".join(failed))
+
+
+def get_megaind_leds(stack):
+    return read_registers(stack[0], megaind.checkStack(stack[1]), ( (megaind.I2C_MEM_RELAY_VAL, 1), ))[0][0] >> 4
+
+
+def health_megaind(stack):
+    # the rest is only read on cards powered from their own input, the ones able to act as master
+    state = { "power_in": drivers[stack].getPowerVolt(stack[1]) }
+    if state["power_in"] >= 5:
+        state["fw"] = drivers[stack].getFwVer(stack[1])
+        state["power_rsp"] = drivers[stack].getRaspVolt(stack[1])
+        state["cpu_temp"] = drivers[stack].getCpuTemp(stack[1])
+        state["wtd_resets"] = drivers[stack].wdtGetResetCount(stack[1])
+        state["wdt_period"] = drivers[stack].wdtGetPeriod(stack[1])
+        state["wdt_default"] = drivers[stack].wdtGetDefaultPeriod(stack[1])
+        state["wdt_off"] = drivers[stack].wdtGetOffInterval(stack[1])
+    return state
 
 
 def watchdog_megaind(stack, mode):
-    if megaind.getPowerVolt(stack) < 5:
+    state = watchdog_health(stack, mode)
+    if state["power_in"] < 5:
         return False
     if mode == 1:
-        if megaind.wdtGetPeriod(stack) != int(config['WATCHDOG']['TIMEOUT']):
-            megaind.wdtSetPeriod(stack, int(config['WATCHDOG']['TIMEOUT']))
-        if megaind.wdtGetDefaultPeriod(stack) != int(config['WATCHDOG']['BOOT']):
-            megaind.wdtSetDefaultPeriod(stack, int(config['WATCHDOG']['BOOT']))
-        if megaind.wdtGetOffInterval(stack) != int(config['WATCHDOG']['RESET']):
-            megaind.wdtSetOffInterval(stack, int(config['WATCHDOG']['RESET']))
+        if state["wdt_period"] != settings["watchdog_timeout"]:
+            drivers[stack].wdtSetPeriod(stack[1], settings["watchdog_timeout"])
+            health.pop(stack, None)
+        if state["wdt_default"] != settings["watchdog_boot"]:
+            drivers[stack].wdtSetDefaultPeriod(stack[1], settings["watchdog_boot"])
+            health.pop(stack, None)
+        if state["wdt_off"] != settings["watchdog_reset"]:
+            drivers[stack].wdtSetOffInterval(stack[1], settings["watchdog_reset"])
+            health.pop(stack, None)
     elif mode == 2:
-        #megaind.wdtSetPeriod(stack, 65000)
+        #drivers[stack].wdtSetPeriod(stack[1], 65000)
         print("megabas.wdtSetPeriod")
     else:
-        megaind.wdtReload(stack)
+        drivers[stack].wdtReload(stack[1])
     return True
 
 
-def get_megabas(stack, init):
-    triacs = megabas.getTriacs(stack)
-    for channel in range(1,5):
-        value = megabas.getUOut(stack, channel)
-        if init or value != cache[stack]["response"]["0_10"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/response/0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["0_10"][channel - 1] = value
+def read_megabas_digital(stack):
+    triacs, contacts, out0_10 = read_registers(stack[0], megabas.HW_ADD + stack[1], ( (megabas.TRIACS_VAL_ADD, 1), (megabas.DRY_CONTACT_VAL_ADD, 1), (megabas.U0_10_OUT_VAL1_ADD, 8) ))
+    return ( bits(triacs[0], 4), bits(contacts[0], 8), [ value / 1000.0 for value in words(out0_10, True) ] )
 
-        if triacs & (1 << channel - 1):
-            value = 1
-        else:
-            value = 0
-        if init or value != cache[stack]["response"]["triac"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/response/triac/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["triac"][channel - 1] = value
-
-    for channel in range(1,9):
-        value = round(megabas.getUIn(stack, channel),2)
-        if init or value != cache[stack]["input"]["0_10"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["0_10"][channel - 1] = value
-
-        value = round(megabas.getRIn1K(stack, channel),2)
-        if init or value != cache[stack]["input"]["1k"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/1k/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["0_10"][channel - 1] = value
-
-        value = round(megabas.getRIn10K(stack, channel), 2)
-        if init or value != cache[stack]["input"]["10k"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/10k/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["10k"][channel - 1] = value
-
-        value = megabas.getContactCh(stack, channel)
-        if init or value != cache[stack]["input"]["cont"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/cont/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["cont"][channel - 1] = value
-
-        value = megabas.getContactCounter(stack, channel)
-        if init or value != cache[stack]["input"]["cont_count"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/cont_count/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["cont_count"][channel - 1] = value
-
-        value = megabas.getContactCountEdge(stack, channel)
-        if value == 1:
-            raising = 1
-            falling = 0
-        elif value == 2:
-            raising = 0
-            falling = 1
-        elif value == 3:
-            raising = 1
-            falling = 1
-        else:
-            raising = 0
-            falling = 0
-        if init or raising != cache[stack]["response"]["cont_rce"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/response/cont_rce/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["cont_rce"][channel - 1] = raising
-        if init or falling != cache[stack]["response"]["cont_fce"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/response/cont_fce/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["cont_fce"][channel - 1] = falling
 
-    megabas.getTriacs(stack)
+def read_megabas_counters(stack):
+    rising, falling = read_registers(stack[0], megabas.HW_ADD + stack[1], ( (megabas.I2C_MEM_DRY_CONTACT_RISING_ENABLE, 1), (megabas.I2C_MEM_DRY_CONTACT_FALLING_ENABLE, 1) ))
+    counts = read_registers(stack[0], megabas.HW_ADD + stack[1], ( (megabas.I2C_MEM_DRY_CONTACT_COUNTERS, 32), ))[0]
+    return ( bits(rising[0], 8), bits(falling[0], 8), [ counts[i] + (counts[i + 1] << 8) + (counts[i + 2] << 16) + (counts[i + 3] << 24) for i in range(0, 32, 4) ] )
+
+
+def read_megabas_analog(stack):
+    in0_10, in1k, in10k = read_registers(stack[0], megabas.HW_ADD + stack[1], ( (megabas.U0_10_IN_VAL1_ADD, 16), (megabas.R_1K_CH1, 16), (megabas.R_10K_CH1, 16) ))
+    return ( [ round(value / 1000.0, 2) for value in words(in0_10, True) ], [ round(value / 1000.0, 2) for value in words(in1k) ], [ round(value / 1000.0, 2) for value in words(in10k) ] )
+
 
 def set_megabas(stack, output, channel, value):
     if output == "0_10" and 1 <= channel <= 4 and 0 <= value <= 10:
         try:
-            megabas.setUOut(stack, channel, value)
-            value = megabas.getUOut(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/response/0_10/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].setUOut(stack[1], channel, value)
+            if write_modes[(stack, "0_10")] == "verified":
+                value = drivers[stack].getUOut(stack[1], channel)
         except:
-            raise AppError("Can't set megabas stack: " + str(stack) + ", response: 0_10, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megabas stack: " + card_stack(stack) + ", response: 0_10, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["0_10"][channel - 1] = value
+            publish_write(stack, "0_10", channel, value)
     elif output == "triac" and 1 <= channel <= 4 and value in [0, 1]:
         try:
-            megabas.setTriac(stack, channel, value)
-            triacs = megabas.getTriacs(stack)
-            if triacs & (1 << channel - 1):
-                value = 1
-            else:
-                value = 0
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/response/triac/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].setTriac(stack[1], channel, value)
+            if write_modes[(stack, "triac")] == "verified":
+                triacs = drivers[stack].getTriacs(stack[1])
+                if triacs & (1 << channel - 1):
+                    value = 1
+                else:
+                    value = 0
         except:
-            raise AppError("Can't set megabas stack: " + str(stack) + ", response: triac, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megabas stack: " + card_stack(stack) + ", response: triac, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["triac"][channel - 1] = value
+            publish_write(stack, "triac", channel, value)
     elif output == "cont_rce" and 1 <= channel <= 8 and value in [0, 1]:
-        if value == 0 and cache[stack]["response"]["cont_fce"][channel - 1] == 1:
+        if value == 0 and cache[card_slot(stack, "response", "cont_fce", channel)] == 1:
             value = 2
-        elif value == 1 and cache[stack]["response"]["cont_fce"][channel - 1] == 0:
+        elif value == 1 and cache[card_slot(stack, "response", "cont_fce", channel)] == 0:
             value = 1
-        elif value == 1 and cache[stack]["response"]["cont_fce"][channel - 1] == 1:
+        elif value == 1 and cache[card_slot(stack, "response", "cont_fce", channel)] == 1:
             value = 3
         else:
             value = 0
         try:
-            megabas.setContactCountEdge(stack, channel, value)
-            value = megabas.getContactCountEdge(stack, channel)
+            drivers[stack].setContactCountEdge(stack[1], channel, value)
+            if write_modes[(stack, "cont_rce")] == "verified":
+                value = drivers[stack].getContactCountEdge(stack[1], channel)
             if value == 1 or value == 3:
                 value = 1
             else:
                 value = 0
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/cont_rce/' + str(channel), str(value), int(config['MQTT']['QOS']))
         except:
-            raise AppError("Can't set megabas stack: " + str(stack) + ", input: cont_rce, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megabas stack: " + card_stack(stack) + ", input: cont_rce, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["cont_rce"][channel - 1] = value
+            publish_write(stack, "cont_rce", channel, value)
     elif output == "cont_fce" and 1 <= channel <= 8 and value in [0, 1]:
-        if value == 0 and cache[stack]["response"]["cont_rce"][channel - 1] == 1:
+        if value == 0 and cache[card_slot(stack, "response", "cont_rce", channel)] == 1:
             value = 1
-        elif value == 1 and cache[stack]["response"]["cont_rce"][channel - 1] == 0:
+        elif value == 1 and cache[card_slot(stack, "response", "cont_rce", channel)] == 0:
             value = 2
-        elif value == 1 and cache[stack]["response"]["cont_rce"][channel - 1] == 1:
+        elif value == 1 and cache[card_slot(stack, "response", "cont_rce", channel)] == 1:
             value = 3
         else:
             value = 0
         try:
-            megabas.setContactCountEdge(stack, channel, value)
-            value = megabas.getContactCountEdge(stack, channel)
+            drivers[stack].setContactCountEdge(stack[1], channel, value)
+            if write_modes[(stack, "cont_fce")] == "verified":
+                value = drivers[stack].getContactCountEdge(stack[1], channel)
             if value == 2 or value == 3:
                 value = 1
             else:
                 value = 0
-            client.publish(config['MQTT']['TOPIC'] + '/megabas/' + str(stack) + '/input/cont_fce/' + str(channel), str(value), int(config['MQTT']['QOS']))
         except:
-            raise AppError("Can't set megabas stack: " + str(stack) + ", input: cont_fce, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set megabas stack: " + card_stack(stack) + ", input: cont_fce, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["cont_fce"][channel - 1] = value
+            publish_write(stack, "cont_fce", channel, value)
     else:
-        raise AppError("Can't set megabas stack: " + str(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
+        raise AppError("Can't set megabas stack: " + card_stack(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
 
 
 def reset_megabas(stack):
+    failed = []
     for channel in range(1,5):
-        for output in ( '0_10', 'triac' ):
-            set_megabas(stack, output, channel, 0)
-
-
-def tele_megabas(stack):
-    if megabas.getInVolt(stack) < 5:
-        return False
-    tele["master"] = "megabas" + str(stack)
-    tele["fw"] = megabas.getVer(stack)
-    tele["power_in"] = megabas.getInVolt(stack)
-    tele["power_rsp"] = megabas.getRaspVolt(stack)
-    tele["cpu_temp"] = megabas.getCpuTemp(stack)
-    tele["wtd_resets"] = megabas.wdtGetResetCount(stack)
-    return True
+        try:
+            set_megabas(stack, '0_10', channel, 0)
+        except AppError as error:
+            failed.append(str(error))
+    write_bank(stack, 'triac', dict.fromkeys(range(1, 5), 0))
+    if failed:
+        raise AppError("; ".join(failed))
+
+
+def health_megabas(stack):
+    # the rest is only read on cards powered from their own input, the ones able to act as master
+    state = { "power_in": drivers[stack].getInVolt(stack[1]) }
+    if state["power_in"] >= 5:
+        state["fw"] = drivers[stack].getVer(stack[1])
+        state["power_rsp"] = drivers[stack].getRaspVolt(stack[1])
+        state["cpu_temp"] = drivers[stack].getCpuTemp(stack[1])
+        state["wtd_resets"] = drivers[stack].wdtGetResetCount(stack[1])
+        state["wdt_period"] = drivers[stack].wdtGetPeriod(stack[1])
+        state["wdt_default"] = drivers[stack].wdtGetDefaultPeriod(stack[1])
+        state["wdt_off"] = drivers[stack].wdtGetOffInterval(stack[1])
+    return state
 
 
 def watchdog_megabas(stack, mode):
-    if megabas.getInVolt(stack) < 5:
+    state = watchdog_health(stack, mode)
+    if state["power_in"] < 5:
         return False
     if mode == 1:
-        if megabas.wdtGetPeriod(stack) != int(config['WATCHDOG']['TIMEOUT']):
-            megabas.wdtSetPeriod(stack, int(config['WATCHDOG']['TIMEOUT']))
-        if megabas.wdtGetDefaultPeriod(stack) != int(config['WATCHDOG']['BOOT']):
-            megabas.wdtSetDefaultPeriod(stack, int(config['WATCHDOG']['BOOT']))
-        if megabas.wdtGetOffInterval(stack) != int(config['WATCHDOG']['RESET']):
-            megabas.wdtSetOffInterval(stack, int(config['WATCHDOG']['RESET']))
+        if state["wdt_period"] != settings["watchdog_timeout"]:
+            drivers[stack].wdtSetPeriod(stack[1], settings["watchdog_timeout"])
+            health.pop(stack, None)
+        if state["wdt_default"] != settings["watchdog_boot"]:
+            drivers[stack].wdtSetDefaultPeriod(stack[1], settings["watchdog_boot"])
+            health.pop(stack, None)
+        if state["wdt_off"] != settings["watchdog_reset"]:
+            drivers[stack].wdtSetOffInterval(stack[1], settings["watchdog_reset"])
+            health.pop(stack, None)
     elif mode == 2:
-        #megabas.wdtSetPeriod(stack, 65000)
+        #drivers[stack].wdtSetPeriod(stack[1], 65000)
         print("megabas.wdtSetPeriod")
     else:
-        megabas.wdtReload(stack)
+        drivers[stack].wdtReload(stack[1])
     return True
 
 
-def get_8relind(stack, init):
-    for channel in range(1,9):
-        value = lib8relind.get(stack, channel)
-        if init or value != cache[stack]["response"]["relay"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/8relind/' + str(stack) + '/response/relay/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["response"]["relay"][channel - 1] = value
+def read_8relind(stack):
+    return ( bits(drivers[stack].get_all(stack[1]), 8), )
 
 
 def set_8relind(stack, output, channel, value):
     if output == "relay" and 1 <= channel <= 8 and value in [0, 1]:
         try:
-            lib8relind.set(stack, channel, value)
-            value = lib8relind.get(stack, channel)
-            client.publish(config['MQTT']['TOPIC'] + '/8relind/' + str(stack) + '/response/relay/' + str(channel), str(value), int(config['MQTT']['QOS']))
+            drivers[stack].set(stack[1], channel, value)
+            if write_modes[(stack, "relay")] == "verified":
+                value = drivers[stack].get(stack[1], channel)
         except:
-            raise AppError("Can't set 8relind stack: " + str(stack) + ", response: relay, channel: " + str(channel) + " to value: " + str(value))
+            raise AppError("Can't set 8relind stack: " + card_stack(stack) + ", response: relay, channel: " + str(channel) + " to value: " + str(value))
         else:
-            cache[stack]["response"]["relay"][channel - 1] = value
+            publish_write(stack, "relay", channel, value)
     else:
-        raise AppError("Can't set 8relind stack: " + str(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
+        raise AppError("Can't set 8relind stack: " + card_stack(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
 
 
 def reset_8relind(stack):
-    for channel in range(1,9):
-        set_8relind(stack, 'relay', channel, 0)
+    write_bank(stack, 'relay', dict.fromkeys(range(1, 9), 0))
+
+
+def read_8inputs(stack):
+    return ( bits(drivers[stack].get_opto_all(stack[1]), 8), )
+
+
+def read_rtd(stack):
+    temperatures = read_registers(stack[0], librtd.DEVICE_ADDRESS + stack[1], ( (librtd.RTD_TEMPERATURE_ADD, 32), ))[0]
+    return ( list(struct.unpack('<8f', bytearray(temperatures))), )
+
+
+# card read plans, every entry is one reader doing a single bulk read (one or two block transfers)
+# returning values of all channels for each listed ( io, signal ) bank, entries are polled
+# at the interval configured for their signal class
+plans = {
+    "megaind": (
+        ( "response", read_megaind_outputs, ( ("response", "0_10"), ("response", "4_20"), ("response", "pwm") ) ),
+        ( "digital", read_megaind_digital, ( ("response", "led"), ("input", "opto") ) ),
+        ( "counter", read_megaind_counters, ( ("response", "opto_rce"), ("response", "opto_fce"), ("input", "opto_count") ) ),
+        ( "analog", read_megaind_analog, ( ("input", "0_10"), ("input", "pm0_10"), ("input", "4_20") ) ),
+    ),
+    "megabas": (
+        ( "digital", read_megabas_digital, ( ("response", "triac"), ("input", "cont"), ("response", "0_10") ) ),
+        ( "counter", read_megabas_counters, ( ("response", "cont_rce"), ("response", "cont_fce"), ("input", "cont_count") ) ),
+        ( "analog", read_megabas_analog, ( ("input", "0_10"), ("input", "1k"), ("input", "10k") ) ),
+    ),
+    "8relind": (
+        ( "response", read_8relind, ( ("response", "relay"), ) ),
+    ),
+    "8inputs": (
+        ( "digital", read_8inputs, ( ("input", "opto"), ) ),
+    ),
+    "rtd": (
+        ( "rtd", read_rtd, ( ("input", "rtd"), ) ),
+    ),
+}
+
+
+# register scale of the analog read-backs, the drivers write int(value * scale) and the read plans divide by it
+response_scales = { "0_10": 1000, "4_20": 1000, "pwm": 100 }
+
+
+# hardware watchdog handlers of the cards able to be master
+watchdogs = { "megaind": watchdog_megaind, "megabas": watchdog_megabas }
+
+# failsafe output resets on a missing heartbeat
+resets = { "megaind": reset_megaind, "megabas": reset_megabas, "8relind": reset_8relind }
+
+
+# writable outputs per card type, output: ( channels, value validator )
+outputs = {
+    "megaind": ( set_megaind, {
+        "0_10": ( 4, lambda value: 0 <= value <= 10 ),
+        "4_20": ( 4, lambda value: 4 <= value <= 20 ),
+        "pwm": ( 4, lambda value: 0 <= value <= 100 ),
+        "led": ( 4, lambda value: value in [0, 1] ),
+        "opto_rce": ( 4, lambda value: value in [0, 1] ),
+        "opto_fce": ( 4, lambda value: value in [0, 1] ),
+        "opto_rst": ( 4, lambda value: value == 1 ),
+    } ),
+    "megabas": ( set_megabas, {
+        "0_10": ( 4, lambda value: 0 <= value <= 10 ),
+        "triac": ( 4, lambda value: value in [0, 1] ),
+        "cont_rce": ( 8, lambda value: value in [0, 1] ),
+        "cont_fce": ( 8, lambda value: value in [0, 1] ),
+    } ),
+    "8relind": ( set_8relind, {
+        "relay": ( 8, lambda value: value in [0, 1] ),
+    } ),
+}
+
+
+# on/off outputs living in one card register: ( channels, register getter, register setter ),
+# commands to them are collected per bank and written with one transaction and one read-back
+output_banks = {
+    "megaind": {
+        "led": ( 4, get_megaind_leds, lambda stack, mask: drivers[stack].setLedAll(stack[1], mask) ),
+    },
+    "megabas": {
+        "triac": ( 4, lambda stack: drivers[stack].getTriacs(stack[1]), lambda stack, mask: drivers[stack].setTriacs(stack[1], mask) ),
+    },
+    "8relind": {
+        "relay": ( 8, lambda stack: drivers[stack].get_all(stack[1]), lambda stack, mask: drivers[stack].set_all(stack[1], mask) ),
+    },
+}
+bank_writes = {}
+bank_lock = threading.Lock()
+
+
+def write_bank(stack, output, values):
+    # read-modify-write of the card register, commands may run before the first poll filled the cache
+    channels, getter, setter = output_banks[cards[stack]][output]
+    mode = write_modes[(stack, output)]
+    mask = None
+    try:
+        mask = getter(stack)
+        for channel, value in values.items():
+            if value:
+                mask |= 1 << (channel - 1)
+            else:
+                mask &= ~(1 << (channel - 1))
+        setter(stack, mask)
+        if mode == "verified":
+            mask = getter(stack)
+    except:
+        raise AppError("Can't set " + cards[stack] + " stack: " + card_stack(stack) + ", response: " + output + ", channels: " + str(sorted(values)) + " to value: " + str(mask))
+    if mode == "fire":
+        for channel in range(1, channels + 1):
+            slot = card_slot(stack, "response", output, channel)
+            cache[slot] = (mask >> (channel - 1)) & 1
+            export_slot(slot)
+            if channel in values:
+                readback.add(slot)
+        return
+    fired = {}
+    for channel in range(1, channels + 1):
+        slot = card_slot(stack, "response", output, channel)
+        value = (mask >> (channel - 1)) & 1
+        if channel in values or cache[slot] != value:
+            if mode == "optimistic":
+                expected[slot] = value
+            cache[slot] = value
+            export_slot(slot)
+            publish_slot(slot)
+            if slot in ruled:
+                fired.update(( id(rule), rule ) for rule in ruled[slot])
+    publish_state(stack)
+    if fired:
+        rules_eval(fired.values())
+
+
+def set_bank(stack, output):
+    with bank_lock:
+        values = bank_writes.pop((stack, output), None)
+    if values:
+        write_bank(stack, output, values)
+
+
+def bank_put(stack, output, values):
+    # the first write of a batch queues the bank task after the coalescing window, later ones join the batch
+    with bank_lock:
+        batch = bank_writes.get((stack, output))
+        if batch is None:
+            bank_writes[(stack, output)] = dict(values)
+        else:
+            batch.update(values)
+    if batch is None:
+        if coalesce > 0:
+            threading.Timer(coalesce, card_put, ( stack, PRIORITY_COMMAND, set_bank, stack, output )).start()
+        else:
+            card_put(stack, PRIORITY_COMMAND, set_bank, stack, output)
 
 
-def get_8inputs(stack, init):
-    for channel in range(1,9):
-        value = lib8inputs.get_opto(stack, channel)
-        if init or value != cache[stack]["input"]["opto"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/8inputs/' + str(stack) + '/input/opto/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["opto"][channel - 1] = value
+def parse_bank(payload, channels):
+    # bitmask like "5", JSON array like [1, 0, 1] from channel 1 or JSON map like {"3": 1}
+    if payload.isdigit():
+        mask = int(payload)
+        if mask >= 1 << channels:
+            return None
+        return { channel: (mask >> (channel - 1)) & 1 for channel in range(1, channels + 1) }
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    if isinstance(data, list) and len(data) <= channels:
+        items = enumerate(data, 1)
+    elif isinstance(data, dict):
+        items = data.items()
+    else:
+        return None
+    values = {}
+    for channel, value in items:
+        if not str(channel).isdigit() or not 1 <= int(channel) <= channels or value not in [0, 1]:
+            return None
+        values[int(channel)] = int(value)
+    return values
+
+
+# channel banks per card type: ( io, signal, channels, integer values )
+banks = {
+    "megaind": (
+        ( "response", "0_10", 4, False ), ( "response", "4_20", 4, False ), ( "response", "pwm", 4, False ),
+        ( "response", "led", 4, True ), ( "response", "opto_rce", 4, True ), ( "response", "opto_fce", 4, True ),
+        ( "input", "0_10", 4, False ), ( "input", "pm0_10", 4, False ), ( "input", "4_20", 4, False ),
+        ( "input", "opto", 4, True ), ( "input", "opto_count", 4, True ),
+    ),
+    "megabas": (
+        ( "response", "0_10", 4, False ), ( "response", "triac", 4, True ),
+        ( "response", "cont_rce", 8, True ), ( "response", "cont_fce", 8, True ),
+        ( "input", "0_10", 8, False ), ( "input", "1k", 8, False ), ( "input", "10k", 8, False ),
+        ( "input", "cont", 8, True ), ( "input", "cont_count", 8, True ),
+    ),
+    "8relind": (
+        ( "response", "relay", 8, True ),
+    ),
+    "8inputs": (
+        ( "input", "opto", 8, True ),
+    ),
+    "rtd": (
+        ( "input", "rtd", 8, False ),
+    ),
+}
+
+
+def layout_init():
+    # lay out every channel of every configured card as one slot of the flat cache array,
+    # with its topic prebuilt, and bind each read plan entry to the first slot of its banks
+    for stack in cards.keys():
+        if stack in slots:
+            # laid out already, a reload only adds the new cards
+            continue
+        slots[stack] = {}
+        changes[stack] = set()
+        state_topics[stack] = settings["topic"] + '/' + card_label(stack) + '/state'
+        for io, signal, channels, integer in banks[cards[stack]]:
+            slots[stack][(io, signal)] = len(cache)
+            for channel in range(1, channels + 1):
+                cache.append(0)
+                integers.append(integer)
+                published_at.append(0)
+                topics.append(settings["topic"] + '/' + card_label(stack) + '/' + io + '/' + signal + '/' + str(channel))
+                slot_stacks.append(stack)
+                slot_keys.append(( io, signal, str(channel) ))
+        for plan in plans[cards[stack]]:
+            bindings[(stack, plan)] = [ slots[stack][bank] for bank in plan[2] ]
+
+
+def filter_parse(key, entry):
+    # "DEADBAND=0.05, MIN=1, MAX=60, EMA=0.3", deadband may be relative like "DEADBAND=2%"
+    spec = { "deadband": 0.0, "relative": False, "min": 0.0, "max": 0.0, "ema": 0.0, "median": 0 }
+    for option in entry.split(','):
+        name, sep, value = option.partition('=')
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == "deadband" and value.endswith('%'):
+                spec["deadband"] = float(value[:-1]) / 100
+                spec["relative"] = True
+            elif name in ( "deadband", "min", "max" ):
+                spec[name] = float(value)
+            elif name == "ema" and 0 < float(value) <= 1:
+                spec["ema"] = float(value)
+            elif name == "median" and int(value) > 0:
+                spec["median"] = int(value)
+            else:
+                raise ValueError(option)
+        except ValueError:
+            raise AppError("Invalid config entry FILTER/" + key + " option: " + option.strip())
+    return spec
 
 
-def get_rtd(stack, init):
-    for channel in range(1,9):
-        value = librtd.get(stack, channel)
-        if init or value != cache[stack]["input"]["rtd"][channel - 1]:
-            client.publish(config['MQTT']['TOPIC'] + '/rtd/' + str(stack) + '/input/rtd/' + str(channel), str(value), int(config['MQTT']['QOS']))
-            cache[stack]["input"]["rtd"][channel - 1] = value
+def filters_init():
+    # FILTER entries are <card>/<signal> for all channels or <card>/<signal>/<channel>
+    if 'FILTER' not in config:
+        return
+    for stack in cards.keys():
+        for io, signal, channels, integer in banks[cards[stack]]:
+            if io != "input" or integer:
+                continue
+            for channel in range(1, channels + 1):
+                for key in ( cards[stack] + '/' + signal + '/' + str(channel), cards[stack] + '/' + signal ):
+                    if config['FILTER'].get(key, raw=True):
+                        filters[card_slot(stack, io, signal, channel)] = filter_parse(key, config['FILTER'].get(key, raw=True))
+                        filtered.add(slots[stack][(io, signal)])
+                        break
+
+
+def filter_value(slot, value, now, init):
+    # smooth the sample and decide if it is worth publishing, returns None to hold it back
+    spec = filters.get(slot)
+    if spec is None:
+        return value if init or value != cache[slot] else None
+    if spec["median"]:
+        window = smoothing.setdefault(slot, collections.deque(maxlen=spec["median"]))
+        window.append(value)
+        value = sorted(window)[len(window) // 2]
+    elif spec["ema"]:
+        if slot in smoothing:
+            value = smoothing[slot] + spec["ema"] * (value - smoothing[slot])
+        smoothing[slot] = value
+        value = round(value, 3)
+    elapsed = now - published_at[slot]
+    if init or (spec["max"] and elapsed >= spec["max"]):
+        return value
+    if value == cache[slot] or elapsed < spec["min"]:
+        return None
+    if spec["relative"]:
+        threshold = spec["deadband"] * abs(cache[slot])
+    else:
+        threshold = spec["deadband"]
+    if abs(value - cache[slot]) < threshold:
+        return None
+    return value
+
+
+def history_parse(key, entry):
+    # "SIZE=600, SUMMARY=60", SIZE samples kept, SUMMARY seconds between aggregates published instead of raw values
+    spec = { "size": 600, "summary": 0.0 }
+    for option in entry.split(','):
+        name, sep, value = option.partition('=')
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == "size" and int(value) > 0:
+                spec["size"] = int(value)
+            elif name == "summary" and float(value) >= 0:
+                spec["summary"] = float(value)
+            else:
+                raise ValueError(option)
+        except ValueError:
+            raise AppError("Invalid config entry HISTORY/" + key + " option: " + option.strip())
+    return spec
 
 
-def cards_init():
-    client.subscribe(config['MQTT']['TOPIC'] + '/tele/cmnd/+', int(config['MQTT']['QOS']))
-    cards_tele(1)
+def history_init():
+    # HISTORY entries are <card>/<signal> for all channels or <card>/<signal>/<channel> of the inputs
+    if 'HISTORY' not in config:
+        return
     for stack in cards.keys():
-        if cards[stack] == "megaind":
-            client.subscribe(config['MQTT']['TOPIC'] + '/' + cards[stack] + '/' + str(stack) + '/output/#', int(config['MQTT']['QOS']))
-            get_megaind(stack, 1)
-            watchdog_megaind(stack, 1)
-        elif cards[stack] == "megabas":
-            client.subscribe(config['MQTT']['TOPIC'] + '/' + cards[stack] + '/' + str(stack) + '/output/#', int(config['MQTT']['QOS']))
-            get_megabas(stack, 1)
-            watchdog_megabas(stack, 1)
-        elif cards[stack] == "8relind":
-            client.subscribe(config['MQTT']['TOPIC'] + '/' + cards[stack] + '/' + str(stack) + '/output/#', int(config['MQTT']['QOS']))
-            get_8relind(stack, 1)
-        elif cards[stack] == "8inputs":
-            get_8inputs(stack, 1)
-        elif cards[stack] == "rtd":
-            get_rtd(stack, 1)
+        for io, signal, channels, integer in banks[cards[stack]]:
+            if io != "input":
+                continue
+            for channel in range(1, channels + 1):
+                for key in ( cards[stack] + '/' + signal + '/' + str(channel), cards[stack] + '/' + signal ):
+                    if config['HISTORY'].get(key, raw=True):
+                        spec = history_parse(key, config['HISTORY'].get(key, raw=True))
+                        slot = card_slot(stack, io, signal, channel)
+                        if slot in history:
+                            break
+                        history[slot] = [ array.array('d', [ 0 ]) * spec["size"], array.array('d', [ 0 ]) * spec["size"], 0, 0 ]
+                        recorded.add(slots[stack][(io, signal)])
+                        if spec["summary"]:
+                            summarized.add(slot)
+                            summaries.setdefault(spec["summary"], []).append(slot)
+                        break
+
+
+def history_reload():
+    # rebuild from the reloaded config, the samples of a ring survive unless its size changed
+    with history_lock:
+        rings = dict(history)
+        history.clear()
+        recorded.clear()
+        summarized.clear()
+        summaries.clear()
+        history_init()
+        for slot, ring in rings.items():
+            if slot in history and len(history[slot][0]) == len(ring[0]):
+                history[slot] = ring
+
+
+def history_record(start, values, now):
+    # every polled sample goes in, changed or not, the oldest one is overwritten
+    with history_lock:
+        for slot, value in enumerate(values, start):
+            ring = history.get(slot)
+            if ring is not None:
+                ring[0][ring[2]] = value
+                ring[1][ring[2]] = now
+                ring[2] = (ring[2] + 1) % len(ring[0])
+                ring[3] = min(ring[3] + 1, len(ring[0]))
+
+
+def history_window(slot, window):
+    # samples of the last window seconds, oldest first, all kept samples without a window
+    with history_lock:
+        values, times, index, count = history[slot]
+        order = [ (index - count + offset) % len(values) for offset in range(count) ]
+        if window:
+            since = time.monotonic() - window
+            order = [ position for position in order if times[position] >= since ]
+        return [ values[position] for position in order ]
+
+
+def history_stats(slot, window, percentiles):
+    samples = history_window(slot, window)
+    state = { "window": window, "count": len(samples) }
+    if samples:
+        state["last"] = samples[-1]
+        samples.sort()
+        state["min"] = samples[0]
+        state["max"] = samples[-1]
+        state["mean"] = round(math.fsum(samples) / len(samples), 4)
+        for percentile in percentiles:
+            state["p" + '%g' % percentile] = samples[min(len(samples) - 1, int(percentile / 100 * len(samples)))]
+    return state
+
+
+def stats_request(payload):
+    # empty payload for all kept samples, a window in seconds or {"window": 60, "percentiles": [ 50, 95 ]}
+    try:
+        request = json.loads(payload) if payload.strip() else {}
+        if not isinstance(request, dict):
+            request = { "window": request }
+        window = float(request.get("window", 0))
+        percentiles = [ float(percentile) for percentile in request.get("percentiles", [ 50, 90, 99 ]) ]
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if window < 0 or any(not 0 <= percentile <= 100 for percentile in percentiles):
+        return None
+    return ( window, percentiles )
+
+
+def history_summary(interval, summary_slots):
+    # downsampled aggregates of the last interval, published instead of the raw values of the channel
+    for slot in summary_slots:
+        io, signal, channel = slot_keys[slot]
+        topic = settings["topic"] + '/' + card_label(slot_stacks[slot]) + '/summary/' + signal + '/' + channel
+        client.publish(topic, json.dumps(history_stats(slot, interval, [ 50 ])), qos, retain)
+        metric_count('publish/summary')
+
+
+def rate_parse(key, entry):
+    # "SCALE=0.5, INTERVAL=10, RAW=0", SCALE turns pulses per second into engineering units, RAW=0 drops the count
+    spec = { "scale": 1.0, "interval": 10.0, "raw": True }
+    for option in entry.split(','):
+        name, sep, value = option.partition('=')
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == "scale":
+                spec["scale"] = float(value)
+            elif name == "interval" and float(value) > 0:
+                spec["interval"] = float(value)
+            elif name == "raw":
+                spec["raw"] = setting_boolean(value)
+            else:
+                raise ValueError(option)
+        except ValueError:
+            raise AppError("Invalid config entry RATE/" + key + " option: " + option.strip())
+    return spec
+
+
+def rates_init():
+    # RATE entries are <card>/<signal> for all channels or <card>/<signal>/<channel> of the counter inputs
+    if 'RATE' not in config:
+        return
+    for stack in cards.keys():
+        for io, signal, channels, integer in banks[cards[stack]]:
+            if signal not in counter_bits:
+                continue
+            for channel in range(1, channels + 1):
+                for key in ( cards[stack] + '/' + signal + '/' + str(channel), cards[stack] + '/' + signal ):
+                    if config['RATE'].get(key, raw=True):
+                        spec = rate_parse(key, config['RATE'].get(key, raw=True))
+                        slot = card_slot(stack, io, signal, channel)
+                        if slot in rates:
+                            break
+                        rates[slot] = [ spec["scale"], None, 0.0, 0, 0.0 ]
+                        rated.add(slots[stack][(io, signal)])
+                        rate_groups.setdefault(spec["interval"], []).append(slot)
+                        if not spec["raw"]:
+                            rate_only.add(slot)
+                        break
+
+
+def rate_reload():
+    # rebuild from the reloaded config, a counter keeps its pulses so far and takes the new scale
+    with rate_lock:
+        counters = dict(rates)
+        rates.clear()
+        rated.clear()
+        rate_groups.clear()
+        rate_only.clear()
+        rates_init()
+        for slot, rate in counters.items():
+            if slot in rates:
+                rates[slot][1:] = rate[1:]
+
+
+def rate_record(start, values, now):
+    # accumulate the pulses since the previous read, a counter wrap is taken modulo the counter width
+    with rate_lock:
+        for slot, value in enumerate(values, start):
+            rate = rates.get(slot)
+            if rate is None:
+                continue
+            if rate[1] is None:
+                rate[4] = now
+            else:
+                rate[3] += (value - rate[1]) % (1 << counter_bits[slot_keys[slot][1]])
+            rate[1] = value
+            rate[2] = now
+
+
+def rate_reset(slot, value):
+    # a counter reset by command restarts the difference from the new count, pulses already seen are kept
+    with rate_lock:
+        if slot in rates and rates[slot][1] is not None:
+            rates[slot][1] = value
+            rates[slot][2] = time.monotonic()
+
+
+def rate_publish(rate_slots):
+    for slot in rate_slots:
+        with rate_lock:
+            scale, count, read_at, pulses, since = rates[slot]
+            if count is None or read_at <= since:
+                continue
+            rates[slot][3] = 0
+            rates[slot][4] = read_at
+        io, signal, channel = slot_keys[slot]
+        topic = settings["topic"] + '/' + card_label(slot_stacks[slot]) + '/rate/' + signal + '/' + channel
+        client.publish(topic, str(round(pulses / (read_at - since) * scale, 6)), qos, retain)
+        metric_count('publish/rate')
+
+
+def export_layout():
+    # (re)write the directory of slot names, a file too small for the layout is replaced by a bigger one
+    global export_map, export_capacity, export_generation
+    if not settings["shared_path"]:
+        return
+    names = json.dumps([ topic[len(settings["topic"]) + 1:] for topic in topics ]).encode('utf-8')
+    if export_map is None or len(topics) > export_capacity or len(names) > export_capacity * EXPORT_NAME_SIZE:
+        capacity = max(64, 2 * len(topics))
+        path = settings["shared_path"] + '.new'
+        with open(path, 'w+b') as file:
+            file.truncate(EXPORT_HEADER_SIZE + capacity * (EXPORT_RECORD.size + EXPORT_NAME_SIZE))
+            mapped = mmap.mmap(file.fileno(), 0)
+        with export_lock:
+            if export_map is not None:
+                end = EXPORT_HEADER_SIZE + len(export_sequences) * EXPORT_RECORD.size
+                mapped[EXPORT_HEADER_SIZE:end] = export_map[EXPORT_HEADER_SIZE:end]
+            while len(export_sequences) < len(topics):
+                export_sequences.append(0)
+            # the new file is complete before it takes the place of the old one, a reader never opens it half written
+            export_generation += 2
+            export_directory(mapped, capacity, names)
+            os.replace(path, settings["shared_path"])
+            if export_map is not None:
+                # readers of the old file see it moved and open the new one
+                struct.pack_into('<I', export_map, 32, EXPORT_MOVED)
+                export_map.close()
+            export_map = mapped
+            export_capacity = capacity
+        return
+    with export_lock:
+        while len(export_sequences) < len(topics):
+            export_sequences.append(0)
+        # the directory changes under an odd generation, readers retry until it is even and unchanged
+        export_generation += 1
+        struct.pack_into('<I', export_map, 32, export_generation)
+        export_generation += 1
+        export_directory(export_map, export_capacity, names)
+
+
+def export_directory(mapped, capacity, names):
+    directory = EXPORT_HEADER_SIZE + capacity * EXPORT_RECORD.size
+    mapped[directory:directory + len(names)] = names
+    EXPORT_HEADER.pack_into(mapped, 0, EXPORT_MAGIC, EXPORT_VERSION, EXPORT_HEADER_SIZE, len(topics), capacity, EXPORT_RECORD.size, EXPORT_HEADER_SIZE, directory, len(names), export_generation, 0, time.time())
+
+
+def export_write(slot, stamp, valid):
+    # seqlock per record: the sequence is odd while the record is written, readers retry on odd or changed sequence,
+    # the lock only orders the writers (bus workers and a growing layout), readers never take it
+    with export_lock:
+        offset = EXPORT_HEADER_SIZE + slot * EXPORT_RECORD.size
+        sequence = export_sequences[slot] + 1
+        struct.pack_into('<I', export_map, offset, sequence)
+        # flags: bit 0 integer value, bit 1 value valid
+        EXPORT_RECORD.pack_into(export_map, offset, sequence, integers[slot] | valid << 1, cache[slot], stamp)
+        struct.pack_into('<I', export_map, offset, sequence + 1)
+        export_sequences[slot] = sequence + 1
+
+
+def export_slot(slot):
+    if export_map is not None:
+        export_write(slot, time.time(), 1)
+
+
+def export_touch():
+    # time of the last finished poll in the header, lets readers tell a quiet channel from a stalled bridge
+    if export_map is not None:
+        with export_lock:
+            struct.pack_into('<d', export_map, 40, time.time())
+
+
+def export_remove(slot):
+    if export_map is not None and slot < len(export_sequences):
+        export_write(slot, 0.0, 0)
+
+
+def card_slot(stack, io, signal, channel):
+    return slots[stack][(io, signal)] + channel - 1
+
+
+def slot_value(slot):
+    if integers[slot]:
+        return int(cache[slot])
+    return cache[slot]
+
+
+def publish_slot(slot):
+    if slot in summarized or slot in rate_only:
+        return
+    if slot in journaled and not client.connected_flag:
+        journal_add(slot)
+    if state_mode != "json":
+        if client.publish(topics[slot], str(slot_value(slot)), qos, retain).rc != mqtt.MQTT_ERR_SUCCESS:
+            unsent.add(slot)
+        metric_count('publish/' + slot_keys[slot][0])
+    if state_mode != "channel":
+        changes[slot_stacks[slot]].add(slot)
+
+
+def publish_state(stack):
+    # one JSON document with all channels of a card changed since the last one
+    if state_mode == "channel" or not changes[stack]:
+        return
+    state = {}
+    changed = sorted(changes[stack])
+    for slot in changed:
+        io, signal, channel = slot_keys[slot]
+        state.setdefault(io, {}).setdefault(signal, {})[channel] = slot_value(slot)
+    changes[stack].clear()
+    if client.publish(state_topics[stack], json.dumps(state), qos, retain).rc != mqtt.MQTT_ERR_SUCCESS:
+        unsent.update(changed)
+    metric_count('publish/state')
+
+
+def publish_write(stack, output, channel, value):
+    # verified publishes the read-back, optimistic the commanded value checked by the next poll,
+    # fire only stores the commanded value for the next writes and leaves the publish to the next poll
+    mode = write_modes[(stack, output)]
+    slot = card_slot(stack, "response", output, channel)
+    if mode == "fire":
+        cache[slot] = value
+        export_slot(slot)
+        readback.add(slot)
+        return
+    if mode == "optimistic":
+        if output in response_scales:
+            # the value the card ends up with, so register rounding is no mismatch
+            value = int(value * response_scales[output]) / response_scales[output]
+        expected[slot] = value
+    publish_command(stack, slot, value)
+
+
+def verify_bank(start, values):
+    # the first read-back after an optimistic write settles it, a differing value goes out as correction with the change detection
+    for slot in range(start, start + len(values)):
+        value = expected.pop(slot, None)
+        if value is not None:
+            if values[slot - start] == value:
+                metric_count('verified/' + slot_keys[slot][1])
+            else:
+                print("Optimistic write mismatch " + topics[slot] + ": " + str(value) + " read back " + str(values[slot - start]))
+                metric_count('mismatch/' + slot_keys[slot][1])
+
+
+def publish_command(stack, slot, value):
+    # store and publish a command read-back, flushing the card state document right away, rules run on what went out
+    cache[slot] = value
+    export_slot(slot)
+    publish_slot(slot)
+    publish_state(stack)
+    if slot in ruled:
+        rules_eval(ruled[slot])
+
+
+def get_plan(stack, plan, init):
+    worker = workers[card_bus(stack)]
+    with worker["lock"]:
+        worker["pending"].discard((stack, plan))
+    if (stack, plan) not in bindings:
+        # card removed by a config reload while the chunk was queued
+        return
+    fired = {}
+    for start, values in zip(bindings[(stack, plan)], plan[1](stack)):
+        if start in recorded:
+            history_record(start, values, time.monotonic())
+        if start in rated:
+            rate_record(start, values, time.monotonic())
+        if start in filtered:
+            now = time.monotonic()
+            for slot, value in enumerate(values, start):
+                value = filter_value(slot, value, now, init)
+                if value is not None:
+                    cache[slot] = value
+                    export_slot(slot)
+                    published_at[slot] = now
+                    publish_slot(slot)
+                    if slot in ruled:
+                        fired.update(( id(rule), rule ) for rule in ruled[slot])
+            continue
+        end = start + len(values)
+        values = array.array('d', values)
+        if expected:
+            verify_bank(start, values)
+        # compare the whole bank at once, walk the channels only when something changed
+        if init or values != cache[start:end] or readback and not readback.isdisjoint(range(start, end)):
+            for slot in range(start, end):
+                if init or values[slot - start] != cache[slot] or slot in readback:
+                    readback.discard(slot)
+                    cache[slot] = values[slot - start]
+                    export_slot(slot)
+                    publish_slot(slot)
+                    if slot in ruled:
+                        fired.update(( id(rule), rule ) for rule in ruled[slot])
+    export_touch()
+    # the card state document goes out once the last queued chunk of the card is done,
+    # pending is shared with get_card on the main and paho threads so it is only walked under the worker lock
+    with worker["lock"]:
+        card_done = not any(key[0] == stack for key in worker["pending"])
+        class_done = not any(key[0] == stack and key[1][0] == plan[0] for key in worker["pending"])
+    if state_mode != "channel" and card_done:
+        publish_state(stack)
+    if stack in unread:
+        unread[stack].discard(plan)
+        if not unread[stack]:
+            unread.pop(stack, None)
+            # rules held back until the card was read once
+            fired.update(( id(rule), rule ) for rule in rules if stack in rule["stacks"])
+    if fired:
+        rules_eval(fired.values())
+    if class_done:
+        metric_cycle(stack, plan[0])
+    if init and snapshot_waiting:
+        snapshot_done(stack, plan)
+
+
+def get_card(stack, init, signal_class=None):
+    # queue one preemptible chunk per read plan entry, entries still waiting in the queue are not queued twice
+    if stack in degraded and time.monotonic() < degraded[stack][1]:
+        return
+    if stack not in drivers:
+        # the library import failed on the worker, it is tried again with the card backoff ahead of the reads
+        card_put(stack, PRIORITY_LOAD, card_load, stack)
+    worker = workers[card_bus(stack)]
+    for plan in plans[cards[stack]]:
+        if signal_class and plan[0] != signal_class:
+            continue
+        with worker["lock"]:
+            if not init and (stack, plan) in worker["pending"]:
+                continue
+            worker["pending"].add((stack, plan))
+        metric_cycle_start(stack, plan[0])
+        card_put(stack, PRIORITY_POLL, get_plan, stack, plan, init)
+
+
+def rule_channel(name, rule_cards):
+    # channel written as its topic without TOPIC: [bus<n>/]<card>/<stack>/<io>/<signal>/<channel>
+    parts = name.split('/')
+    bus = 1
+    if len(parts) == 6 and re.fullmatch(r'bus\d+', parts[0]):
+        bus = int(parts[0][3:])
+        parts = parts[1:]
+    if len(parts) != 5 or not parts[1].isdigit() or not parts[4].isdigit():
+        raise ValueError("unknown channel " + name)
+    card, stack, io, signal, channel = parts
+    stack = ( bus, int(stack) )
+    if rule_cards.get(stack) != card:
+        raise ValueError("no " + card + " card at " + name)
+    return ( stack, io, signal, int(channel) )
+
+
+def rule_parse(name, entry, rule_cards):
+    # NAME = <condition> -> <output> = <value> [else <value>], ...
+    # conditions: channels, comparisons like "> 80 ~ 5" with hysteresis, and, or, not, rise, fall, ( ), "for <seconds>"
+    try:
+        condition, arrow, targets = entry.partition('->')
+        if not arrow:
+            raise ValueError("missing ->")
+        tokens = RULE_TOKENS.findall(condition)
+        tree, position = rule_expression(tokens, 0, rule_cards)
+        if position != len(tokens):
+            raise ValueError("unexpected " + tokens[position])
+        channels = {}
+        rule_channels(tree, channels)
+        for key in channels:
+            stack, io, signal, channel = key
+            count = { bank[:2]: bank[2] for bank in banks[rule_cards[stack]] }.get(( io, signal ), 0)
+            if not 1 <= channel <= count:
+                raise ValueError("unknown channel " + '/'.join(( rule_cards[stack], str(stack[1]), io, signal, str(channel) )))
+        actions = []
+        for target in targets.split(','):
+            output, equal, values = target.partition('=')
+            on, otherwise, off = values.strip().partition(' else ')
+            stack, kind, signal, channel = rule_channel(output.strip(), rule_cards)
+            card_outputs = outputs.get(rule_cards[stack], ( None, {} ))[1]
+            if not equal or kind != "output" or signal not in card_outputs or not 1 <= channel <= card_outputs[signal][0]:
+                raise ValueError("unknown output " + target.strip())
+            values = []
+            for value in ( on.strip(), off.strip() if otherwise else None ):
+                if value == "toggle" and ( "response", signal ) in [ bank[:2] for bank in banks[rule_cards[stack]] ]:
+                    values.append(value)
+                elif value is not None:
+                    number = parse_value(value.encode('utf-8'))
+                    if number is None or not card_outputs[signal][1](number):
+                        raise ValueError("invalid value " + value + " for " + output.strip())
+                    values.append(number)
+                else:
+                    values.append(None)
+            actions.append(( stack, signal, channel, values[0], values[1] ))
+    except IndexError:
+        raise AppError("Invalid config entry RULES/" + name + ": incomplete condition")
+    except ValueError as error:
+        raise AppError("Invalid config entry RULES/" + name + ": " + str(error))
+    return tree, actions
+
+
+def rule_expression(tokens, position, rule_cards):
+    terms = []
+    while True:
+        term, position = rule_term(tokens, position, rule_cards)
+        terms.append(term)
+        if position < len(tokens) and tokens[position] == "or":
+            position += 1
         else:
-            raise AppError("Uknown card type " + cards[stack])
-    client.subscribe(config['MQTT']['TOPIC'] + '/' + config['HEARTBEAT']['TOPIC_CHALLENGE'])
+            return ( terms[0] if len(terms) == 1 else ( "or", terms ) ), position
 
 
-def cards_update(mode):
-    if cards_tele(mode):
-        mode = 1
+def rule_term(tokens, position, rule_cards):
+    factors = []
+    while True:
+        factor, position = rule_factor(tokens, position, rule_cards)
+        factors.append(factor)
+        if position < len(tokens) and tokens[position] == "and":
+            position += 1
+        else:
+            return ( factors[0] if len(factors) == 1 else ( "and", factors ) ), position
+
+
+def rule_factor(tokens, position, rule_cards):
+    token = tokens[position]
+    if token in ( "not", "rise", "fall" ):
+        inner, position = rule_factor(tokens, position + 1, rule_cards)
+        return ( token, inner ), position
+    if token == "(":
+        tree, position = rule_expression(tokens, position + 1, rule_cards)
+        if tokens[position] != ")":
+            raise ValueError("missing )")
+        position += 1
+    else:
+        tree = ( "channel", rule_channel(token, rule_cards), None, 0.0, 0.0 )
+        position += 1
+        if position < len(tokens) and tokens[position] in RULE_OPERATORS:
+            compare, limit, band = tokens[position], float(tokens[position + 1]), 0.0
+            position += 2
+            if position < len(tokens) and tokens[position] == "~":
+                band = float(tokens[position + 1])
+                position += 2
+                if compare in ( "==", "!=" ) or band < 0:
+                    raise ValueError("hysteresis needs <, <=, > or >=")
+            tree = ( "channel", tree[1], compare, limit, band )
+    if position < len(tokens) and tokens[position] == "for":
+        tree = ( "for", tree, float(tokens[position + 1]) )
+        position += 2
+    return tree, position
+
+
+def rule_channels(tree, channels):
+    if tree[0] == "channel":
+        channels[tree[1]] = True
+    elif tree[0] in ( "and", "or" ):
+        for part in tree[1]:
+            rule_channels(part, channels)
     else:
-        mode = 0
+        rule_channels(tree[1], channels)
+
+
+def rule_compile(tree, rule):
+    # every node is a function of the evaluation time, stateful nodes (edges, hysteresis, timers) keep their state
+    # in the closure and every node is evaluated on every pass so that state stays current
+    kind = tree[0]
+    if kind == "channel":
+        slot = card_slot(*tree[1])
+        compare, limit, band = tree[2:]
+        if compare is None:
+            return lambda now: cache[slot] != 0
+        state = [ False ]
+
+        def evaluate(now):
+            # once on, a comparison stays on until the value is back past the limit by the band
+            threshold = limit
+            if state[0] and band:
+                threshold = limit - band if compare[0] == '>' else limit + band
+            state[0] = RULE_OPERATORS[compare](cache[slot], threshold)
+            return state[0]
+        return evaluate
+    if kind in ( "and", "or" ):
+        parts = [ rule_compile(part, rule) for part in tree[1] ]
+        combine = all if kind == "and" else any
+        return lambda now: combine([ part(now) for part in parts ])
+    inner = rule_compile(tree[1], rule)
+    if kind == "not":
+        return lambda now: not inner(now)
+    if kind in ( "rise", "fall" ):
+        previous = [ None ]
+
+        def evaluate(now):
+            value = inner(now)
+            edge = previous[0] is not None and value != previous[0] and value == ( kind == "rise" )
+            previous[0] = value
+            return edge
+        return evaluate
+    seconds = tree[2]
+    since = [ None ]
+
+    def evaluate(now):
+        # true once the inner condition held for the whole time, until then a timer wakes the rule up
+        if not inner(now):
+            since[0] = None
+            return False
+        if since[0] is None:
+            since[0] = now
+        if now - since[0] >= seconds:
+            return True
+        rule["wake"] = min(rule["wake"] or math.inf, since[0] + seconds)
+        return False
+    return evaluate
+
+
+def rules_init():
+    # RULES entries are compiled to closures over the cache, evaluated on the bus worker that saw the change
+    global rules, ruled
+    compiled = []
+    readers = {}
+    if 'RULES' in config:
+        for name in config['RULES']:
+            if not config['RULES'].get(name, raw=True):
+                continue
+            tree, actions = rule_parse(name, config['RULES'].get(name, raw=True), cards)
+            rule = { "name": name, "state": None, "wake": None, "timer": None, "actions": [] }
+            rule["condition"] = rule_compile(tree, rule)
+            channels = {}
+            rule_channels(tree, channels)
+            rule["stacks"] = set(key[0] for key in channels)
+            for stack, signal, channel, on, off in actions:
+                response = card_slot(stack, "response", signal, channel) if ( "response", signal ) in slots[stack] else None
+                rule["actions"].append(( settings["topic"] + '/' + card_label(stack) + '/output/' + signal + '/' + str(channel), on, off, response ))
+            rule["topic"] = settings["topic"] + '/rule/' + name
+            for key in channels:
+                readers.setdefault(card_slot(*key), []).append(rule)
+            compiled.append(rule)
+    with rules_lock:
+        rules = compiled
+        ruled = readers
+
+
+def rules_eval(fired):
+    # evaluate the rules, a rule changing state sends its outputs right away and publishes its new state
+    now = time.monotonic()
+    commands = []
+    changed = []
+    with rules_lock:
+        for rule in fired:
+            if any(stack in unread or stack in degraded for stack in rule["stacks"]):
+                # an interlock never acts on channels not read yet or gone stale on a failing card
+                continue
+            rule["wake"] = None
+            state = rule["condition"](now)
+            if rule["wake"] is not None and ( rule["timer"] is None or rule["wake"] < rule["timer"] ):
+                rule["timer"] = rule["wake"]
+                threading.Timer(rule["wake"] - now, rule_timer, ( rule, rule["wake"] )).start()
+            if state == rule["state"]:
+                continue
+            rule["state"] = state
+            changed.append(rule)
+            for topic, on, off, response in rule["actions"]:
+                value = on if state else off
+                if value == "toggle":
+                    value = 0 if cache[response] else 1
+                if value is not None:
+                    commands.append(( topic, value ))
+    for topic, value in commands:
+        command_put(topic, value)
+    for rule in changed:
+        client.publish(rule["topic"], str(int(rule["state"])), qos, retain)
+        metric_count('rules/' + ( 'on' if rule["state"] else 'off' ))
+
+
+def rule_timer(rule, deadline):
+    with rules_lock:
+        if rule["timer"] != deadline or rule not in rules:
+            # superseded by an earlier timer or dropped by a config reload
+            return
+        rule["timer"] = None
+    rules_eval([ rule ])
+
+
+def journal_init():
+    # [JOURNAL] PATH enables it, CLASSES opts signal classes in, RETENTION seconds and SIZE rows bound it
+    global journal
+    if not settings["journal_path"]:
+        return
+    journal_slots()
+    journal = sqlite3.connect(settings["journal_path"], check_same_thread=False, isolation_level=None)
+    journal.execute('PRAGMA journal_mode=WAL')
+    journal.execute('PRAGMA synchronous=NORMAL')
+    journal.execute('CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, topic TEXT, payload TEXT)')
+    journal_prune()
+
+
+def journal_slots():
+    # rebuilt on reload, swapped in place so a worker never sees the set empty
+    fresh = set()
     for stack in cards.keys():
-        if cards[stack] == "megaind":
-            get_megaind(stack, mode)
-        elif cards[stack] == "megabas":
-            get_megabas(stack, mode)
-        elif cards[stack] == "8relind":
-            get_8relind(stack, mode)
-        elif cards[stack] == "8inputs":
-            get_8inputs(stack, mode)
-        elif cards[stack] == "rtd":
-            get_rtd(stack, mode)
-        else:
-            raise AppError("Uknown card type " + cards[stack])
+        channels = { ( io, signal ): count for io, signal, count, integer in banks[cards[stack]] }
+        for plan in plans[cards[stack]]:
+            if plan[0] in settings["journal_classes"]:
+                for bank in plan[2]:
+                    fresh.update(range(slots[stack][bank], slots[stack][bank] + channels[bank]))
+    journaled.intersection_update(fresh)
+    journaled.update(fresh)
+
+
+def journal_prune():
+    with journal_lock:
+        journal.execute('DELETE FROM journal WHERE time < ?', ( time.time() - settings["journal_retention"], ))
+        journal.execute('DELETE FROM journal WHERE id <= (SELECT MAX(id) FROM journal) - ?', ( settings["journal_size"], ))
+
+
+def journal_add(slot):
+    # the change is stored with its wall clock time, the topic relative to TOPIC
+    topic = topics[slot][len(settings["topic"]) + 1:]
+    # the value as JSON, nan or inf of a broken sensor goes in as a string
+    value = slot_value(slot)
+    payload = json.dumps(value if math.isfinite(value) else str(value))
+    with journal_lock:
+        journal.execute('INSERT INTO journal (time, topic, payload) VALUES (?, ?, ?)', ( time.time(), topic, payload ))
+    metric_count('journal/stored')
+    if next(journal_inserts) % 1000 == 0:
+        journal_prune()
+
+
+def journal_replay(connection):
+    # drain the backlog oldest first on TOPIC/journal/..., RATE messages per second, rows go once published
+    delay = 1.0 / settings["journal_rate"]
+    try:
+        while connection is client and connection.connected_flag:
+            with journal_lock:
+                rows = journal.execute('SELECT id, time, topic, payload FROM journal ORDER BY id LIMIT 100').fetchall()
+            if not rows:
+                break
+            for row, stamp, topic, payload in rows:
+                try:
+                    value = json.loads(payload)
+                except ValueError:
+                    # a row that can't be replayed is dropped instead of blocking the rest of the backlog
+                    print("Journal row " + str(row) + " of " + topic + " dropped, invalid value:", payload)
+                    with journal_lock:
+                        journal.execute('DELETE FROM journal WHERE id = ?', ( row, ))
+                    metric_count('journal/dropped')
+                    continue
+                document = { "time": datetime.datetime.fromtimestamp(stamp).isoformat(timespec='milliseconds'), "value": value }
+                if connection.publish(settings["topic"] + '/journal/' + topic, json.dumps(document), qos).rc != mqtt.MQTT_ERR_SUCCESS:
+                    return
+                with journal_lock:
+                    journal.execute('DELETE FROM journal WHERE id = ?', ( row, ))
+                metric_count('journal/replayed')
+                time.sleep(delay)
+    finally:
+        journal_draining.clear()
+
+
+def journal_start():
+    # one drain at a time on its own thread, live polling goes on meanwhile
+    if journal is None or journal_draining.is_set():
+        return
+    journal_prune()
+    journal_draining.set()
+    threading.Thread(target=journal_replay, args=(client,), daemon=True).start()
+
+
+def cards_resync():
+    # after a reconnect only publish what could not be sent during the outage, the polls add what changed since
+    for slot in sorted(unsent):
+        unsent.discard(slot)
+        publish_slot(slot)
+    for stack in cards.keys():
+        publish_state(stack)
+
+
+def cards_init():
+    # every subscription goes first so commands work right away, the first snapshot streams out per card
+    # behind them and the watchdog and health reads queue up after the snapshot
+    init = 0 if synced else 1
+    if synced:
+        cards_resync()
+    client.subscribe(settings["topic"] + '/tele/cmnd/+', qos)
+    client.subscribe(settings["topic"] + '/' + settings["heartbeat_challenge"])
+    for stack in cards.keys():
+        card_subscribe(stack)
+    if not synced:
+        startup_mark("subscribed")
+        systemd_notify("STATUS=Connected to the broker, reading the cards")
+        with snapshot_lock:
+            for stack in cards.keys():
+                snapshot_waiting[stack] = set(plans[cards[stack]])
+    for stack in cards.keys():
+        card_init(stack, init, False)
+    cards_tele(PRIORITY_POLL)
+
+
+def card_init(stack, init, subscribe=True):
+    if subscribe:
+        card_subscribe(stack)
+    if init:
+        unread[stack] = set(plans[cards[stack]])
+    get_card(stack, init)
+    if cards[stack] in watchdogs:
+        card_put(stack, PRIORITY_POLL, watchdogs[cards[stack]], stack, 1)
+
+
+def startup_mark(phase):
+    startup[phase] = round(time.monotonic() - process_start, 3)
+
+
+def snapshot_done(stack, plan, failed=False):
+    # called when a read plan of the first snapshot finished or its card failed, the last card publishes the report
+    with snapshot_lock:
+        if stack not in snapshot_waiting:
+            return
+        snapshot_waiting[stack].discard(plan)
+        if snapshot_waiting[stack] and not failed:
+            return
+        del snapshot_waiting[stack]
+        startup["cards"][card_label(stack)] = "failed" if failed else round(time.monotonic() - process_start, 3)
+        if snapshot_waiting:
+            return
+    startup_mark("snapshot")
+    print("Startup", json.dumps(startup))
+    systemd_notify("STATUS=First snapshot published in " + str(startup["snapshot"]) + " s")
+    client.publish(settings["topic"] + '/tele/STARTUP', json.dumps(startup), qos, True)
+
+
+def systemd_notify(state):
+    # sd_notify for Type=notify units, nothing to do when not started by systemd
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return
+    if path.startswith('@'):
+        path = '\0' + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(path)
+            sock.sendall(state.encode('utf-8'))
+    except OSError as error:
+        print("Can't notify systemd:", error)
+
+
+def card_subscribe(stack):
+    if cards[stack] in outputs:
+        client.subscribe(settings["topic"] + '/' + card_label(stack) + '/output/#', qos)
+    if any(slot_stacks[slot] == stack for slot in history):
+        client.subscribe(settings["topic"] + '/' + card_label(stack) + '/stats/+/+', qos)
+
+
+def card_unsubscribe(stack):
+    if cards[stack] in outputs:
+        client.unsubscribe(settings["topic"] + '/' + card_label(stack) + '/output/#')
+    if any(slot_stacks[slot] == stack for slot in history):
+        client.unsubscribe(settings["topic"] + '/' + card_label(stack) + '/stats/+/+')
+
+
+def cards_update():
+    cards_tele()
+    for stack in cards.keys():
+        get_card(stack, 1)
 
 
 def cards_unsubscribe():
-    client.unsubscribe(config['MQTT']['TOPIC'] + '/tele/cmnd/+', int(config['MQTT']['QOS']))
-    client.unsubscribe(config['MQTT']['TOPIC'] + '/' + config['HEARTBEAT']['TOPIC_CHALLENGE'])
+    # a persistent session keeps its subscriptions so commands sent while the bridge is away get queued
+    if session == 'clean':
+        client.unsubscribe(settings["topic"] + '/tele/cmnd/+')
+        client.unsubscribe(settings["topic"] + '/' + settings["heartbeat_challenge"])
     for stack in cards.keys():
+        if cards[stack] in watchdogs:
+            card_put(stack, PRIORITY_HEALTH, watchdogs[cards[stack]], stack, 2)
+        if session == 'clean':
+            card_unsubscribe(stack)
+
+
+def card_health(stack):
+    # power, temperature, firmware and watchdog config read once per HEALTH seconds, shared by tele and watchdog
+    entry = health.get(stack)
+    now = time.monotonic()
+    if entry is None or entry[0] <= now:
         if cards[stack] == "megaind":
-            watchdog_megaind(stack, 2)
-        elif cards[stack] == "megabas":
-            watchdog_megabas(stack, 2)
-        client.unsubscribe(config['MQTT']['TOPIC'] + '/' + cards[stack] + '/#', int(config['MQTT']['QOS']))
+            entry = ( now + health_ttl, health_megaind(stack) )
+        else:
+            entry = ( now + health_ttl, health_megabas(stack) )
+        health[stack] = entry
+    return entry[1]
+
+
+def watchdog_health(stack, mode):
+    # a reload goes by the last health reading even when expired, so it never waits on the health reads
+    if mode == 0 and stack in health:
+        return health[stack][1]
+    return card_health(stack)
+
+
+def tele_card(stack, state):
+    # the first master card fills the top level fields, with TELE_MASTERS = all every master is listed
+    name = card_label(stack).replace('/', '')
+    fields = { "fw": state["fw"], "power_in": state["power_in"], "power_rsp": state["power_rsp"], "cpu_temp": state["cpu_temp"], "wtd_resets": state["wtd_resets"] }
+    if "master" not in tele:
+        tele["master"] = name
+        tele.update(fields)
+    if tele_masters == "all":
+        tele.setdefault("masters", {})[name] = fields
+
+
+def cards_tele(priority=PRIORITY_HEALTH):
+    # health of every card able to be master is read on its own bus worker, the last one publishes
+    stacks = [ stack for stack in cards.keys() if cards[stack] in ( "megaind", "megabas" ) and stack not in degraded ]
+    with tele_lock:
+        tele_waiting.clear()
+        tele_waiting.update(stacks)
+    if not stacks:
+        tele_publish()
+    for stack in stacks:
+        card_put(stack, priority, tele_read, stack)
+
+
+def tele_read(stack):
+    try:
+        card_health(stack)
+    finally:
+        with tele_lock:
+            last = stack in tele_waiting and len(tele_waiting) == 1
+            tele_waiting.discard(stack)
+        if last:
+            tele_publish()
+
+
+def tele_publish():
+    get_time()
+    for key in ( "master", "fw", "power_in", "power_rsp", "cpu_temp", "wtd_resets", "masters" ):
+        tele.pop(key, None)
+    for stack in sorted(cards.keys()):
+        if stack in degraded or stack not in health:
+            continue
+        state = health[stack][1]
+        if state["power_in"] < 5:
+            continue
+        tele_card(stack, state)
+        if tele_masters == "first":
+            break
+    client.publish(settings["topic"] + '/tele/STATE', json.dumps(tele), qos)
+    metric_count('publish/tele')
+
+
+def safety_start():
+    threading.Thread(target=safety_run, daemon=True).start()
+
+
+def safety_run():
+    # watchdog reloads and the heartbeat check run here on their own deadlines, never behind the main loop,
+    # their bus I/O jumps every queued poll on the bus worker, a read already running on the bus is finished first
+    if settings["watchdog_realtime"] > 0:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(settings["watchdog_realtime"]))
+        except ( AttributeError, OSError ) as error:
+            print("Can't set realtime priority of the safety thread:", error)
+    now = time.monotonic()
+    due_watchdog = now + settings["watchdog_timeout"] / 3
+    due_heartbeat = now + 1
+    while True:
+        due = min(due_watchdog, due_heartbeat)
+        now = time.monotonic()
+        if due > now:
+            time.sleep(due - now)
+            now = time.monotonic()
+        # wakeup jitter, how late the thread got the CPU after its deadline
+        metric_time("safety", "wakeup", now - due, 0)
+        try:
+            if due_watchdog <= now:
+                safety_watchdog(due_watchdog)
+                due_watchdog = safety_next(due_watchdog, settings["watchdog_timeout"] / 3, now)
+            if due_heartbeat <= now:
+                safety_heartbeat()
+                due_heartbeat = safety_next(due_heartbeat, 1, now)
+        except Exception as error:
+            print("An exception occurred:", type(error).__name__, "–", error)
+            metric_count('errors/bridge')
+            due_watchdog = max(due_watchdog, now + 1)
+            due_heartbeat = max(due_heartbeat, now + 1)
+
+
+def safety_next(deadline, interval, now):
+    # fixed rate, missed deadlines are skipped instead of run back to back
+    deadline += interval
+    if deadline <= now:
+        skipped = math.ceil((now - deadline) / interval)
+        deadline += interval * skipped
+        metric_count('safety/skipped', skipped)
+    return deadline
+
+
+def safety_watchdog(due):
+    # the card watchdog is reloaded only while the bridge is connected, a broker outage still ends in a power cycle
+    if not synced or not client.connected_flag:
+        return
+    for stack in list(cards.keys()):
+        if cards.get(stack) not in watchdogs:
+            continue
+        if stack in safety_pending:
+            # the previous reload did not even start, the bus is stuck in a single transfer
+            print("Watchdog reload of card " + card_label(stack) + " still queued")
+            metric_count('safety/deadline_missed')
+            continue
+        safety_pending.add(stack)
+        card_put(stack, PRIORITY_SAFETY, safety_reload, stack, due)
+
+
+def safety_reload(stack, due):
+    # latency counts from the deadline of the reload, over DEADLINE seconds is a miss
+    try:
+        if stack in cards:
+            watchdogs[cards[stack]](stack, 0)
+    finally:
+        safety_pending.discard(stack)
+        latency = time.monotonic() - due
+        metric_time("safety", "watchdog", latency, 0)
+        if latency > settings["watchdog_deadline"]:
+            print("Watchdog reload of card " + card_label(stack) + " late by " + str(round(latency, 3)) + " s")
+            metric_count('safety/deadline_missed')
 
 
-def cards_tele(mode):
-    global last_tele
-    now = time.time()
-    if now - last_tele > 300 or mode == 1:
-        get_time()
-        for stack in cards.keys():
-            if cards[stack] == "megaind":
-                if tele_megaind(stack):
-                    break
-            elif cards[stack] == "megabas":
-                if tele_megabas(stack):
-                    break
-        client.publish(config['MQTT']['TOPIC'] + '/tele/STATE', json.dumps(tele), int(config['MQTT']['QOS']))
-        last_tele = now
-        return True
-    else:
-        return False
+def safety_heartbeat():
+    # outputs are reset right away, the main loop restarts the connection as before
+    global safety_error
+    if not check_heartbeat(0) and client is not None and client.connected_flag:
+        safety_error = "Missing heartbeat, all cards outputs reseted!"
+        runtime_wake()
 
 
-def cards_watchdog():
-    global last_watchdog
-    now = int(time.time())
-    if now - last_watchdog > int(config['WATCHDOG']['TIMEOUT']) / 3:
+def safety_check():
+    global safety_error
+    if safety_error:
+        error, safety_error = safety_error, None
+        raise AppError(error)
+
+
+def card_bus(stack):
+    return stack[0]
+
+
+def card_put(stack, priority, task, *args):
+    worker_put(card_bus(stack), priority, task, *args)
+
+
+def worker_put(bus, priority, task, *args):
+    workers[bus]["queue"].put(( priority, next(worker_sequence), task, args ))
+
+
+def worker_run(bus):
+    # serialize all I/O of one bus, lowest priority value first, FIFO within a priority
+    while True:
+        priority, sequence, task, args = workers[bus]["queue"].get()
+        start = time.perf_counter()
+        try:
+            task(*args)
+        except Exception as error:
+            # errors stay with the command or card that caused them, the session goes on
+            metric_task(task, args, start, 1)
+            if priority == PRIORITY_COMMAND and len(args) == 4:
+                stack, output, channel, value = args
+                command_error(settings["topic"] + '/' + card_label(stack) + '/output/' + output + '/' + str(channel), str(value), error)
+            elif task is set_bank:
+                stack, output = args
+                command_error(settings["topic"] + '/' + card_label(stack) + '/output/' + output, "", error)
+            elif task in resets.values():
+                # a failed output reset is reported, it says nothing about the card inputs so polling goes on
+                print("Output reset of card " + card_label(args[0]) + " failed:", type(error).__name__, "–", error)
+                metric_count('errors/reset')
+            elif args and args[0] in cards:
+                card_fault(args[0], error)
+            else:
+                print("An exception occurred:", type(error).__name__, "–", error)
+                metric_count('errors/bridge')
+        else:
+            metric_task(task, args, start, 0)
+            # only a read proves the card is back, writes and health reads may go through while the polls fail
+            if task is get_plan and args[0] in degraded:
+                card_recover(args[0])
+
+
+def retry_delay(failures):
+    # exponential backoff of a degraded card, RETRY doubled on every failure up to RETRY_MAX
+    base = settings["poll"].get('RETRY', 1.0)
+    limit = settings["poll"].get('RETRY_MAX', 300.0)
+    return min(base * 2 ** (failures - 1), limit)
+
+
+def card_fault(stack, error):
+    now = time.monotonic()
+    if stack in degraded and now < degraded[stack][1]:
+        # chunks queued before the card failed, already backing off
+        return
+    failures = degraded[stack][0] + 1 if stack in degraded else 1
+    delay = retry_delay(failures)
+    degraded[stack] = ( failures, now + delay )
+    print("Card " + card_label(stack) + " degraded, retry in " + str(delay) + " s:", type(error).__name__, "–", error)
+    if snapshot_waiting:
+        snapshot_done(stack, None, True)
+    metric_count('errors/card')
+    metric_cycle_reset(stack)
+    if failures == 1:
+        card_status(stack, "degraded")
+
+
+def card_recover(stack):
+    degraded.pop(stack, None)
+    print("Card " + card_label(stack) + " recovered")
+    card_status(stack, "online")
+    # rules skipped while the card was failing catch up on the fresh read
+    rules_eval([ rule for rule in rules if stack in rule["stacks"] ])
+
+
+def card_status(stack, status):
+    client.publish(settings["topic"] + '/' + card_label(stack) + '/status', status, qos, retain)
+    metric_count('publish/status')
+
+
+def command_error(topic, payload, error):
+    # reject a command with an error reply instead of raising in the MQTT network thread
+    print("Command rejected:", topic, "–", error)
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', 'replace')
+    client.publish(settings["topic"] + '/tele/ERROR', json.dumps({ "topic": topic, "payload": payload, "error": str(error) }), qos)
+    metric_count('errors/command')
+    metric_count('publish/error')
+
+
+def worker_start():
+    for stack in cards.keys():
+        bus = card_bus(stack)
+        if bus not in workers:
+            workers[bus] = { "queue": queue.PriorityQueue(), "pending": set(), "lock": threading.Lock() }
+            threading.Thread(target=worker_run, args=(bus,), daemon=True).start()
+        if stack not in drivers:
+            card_put(stack, PRIORITY_LOAD, card_load, stack)
+
+
+def poll_interval(stack, signal_class):
+    # per card override STACKn_<CLASS> wins over the <CLASS> default
+    for key in ( card_key(stack) + '_' + signal_class, signal_class ):
+        if key.upper() in settings["poll"]:
+            return settings["poll"][key.upper()]
+    return 1.0
+
+
+def schedule_add(interval, task, *args):
+    heapq.heappush(schedule, ( time.monotonic() + interval, next(schedule_sequence), interval, task, args ))
+
+
+def schedule_init():
+    schedule.clear()
+    for stack in cards.keys():
+        for signal_class in sorted(set(plan[0] for plan in plans[cards[stack]])):
+            schedule_add(poll_interval(stack, signal_class), get_card, stack, 0, signal_class)
+    schedule_add(settings["poll"].get('TELE', 300), cards_update)
+    if settings["metrics_interval"] > 0:
+        schedule_add(settings["metrics_interval"], metrics_publish)
+    for interval, summary_slots in summaries.items():
+        schedule_add(interval, history_summary, interval, summary_slots)
+    for interval, rate_slots in rate_groups.items():
+        schedule_add(interval, rate_publish, rate_slots)
+
+
+def schedule_run(only=None):
+    # run all due tasks, or just the ones in only while the broker is away, return time left to the next deadline
+    now = time.monotonic()
+    while schedule[0][0] <= now:
+        deadline, sequence, interval, task, args = heapq.heappop(schedule)
+        if only is None or task in only:
+            task(*args)
+        now = time.monotonic()
+        deadline += interval
+        if deadline <= now:
+            # task overran, skip missed cycles instead of running them back to back
+            skipped = math.ceil((now - deadline) / interval)
+            deadline += interval * skipped
+            metric_count('schedule/skipped', skipped)
+        heapq.heappush(schedule, ( deadline, sequence, interval, task, args ))
+    return schedule[0][0] - now
+
+
+def card_label(stack):
+    # topic path of a card, cards on other buses than 1 live in their own bus<N> namespace
+    if stack[0] == 1:
+        return cards[stack] + '/' + str(stack[1])
+    return 'bus' + str(stack[0]) + '/' + cards[stack] + '/' + str(stack[1])
+
+
+def card_stack(stack):
+    if stack[0] == 1:
+        return str(stack[1])
+    return 'bus' + str(stack[0]) + '/' + str(stack[1])
+
+
+def card_key(stack):
+    # config key of a card, STACKn on bus 1 and BUSm_STACKn elsewhere
+    if stack[0] == 1:
+        return 'STACK' + str(stack[1])
+    return 'BUS' + str(stack[0]) + '_STACK' + str(stack[1])
+
+
+def metrics_init():
+    # counts survive a config reload, intervals follow it
+    with metrics_lock:
+        for key in [ key for key in cycles if key[0] not in cards ]:
+            del cycles[key]
         for stack in cards.keys():
-            if cards[stack] == "megaind":
-                watchdog_megaind(stack, 0)
-            elif cards[stack] == "megabas":
-                watchdog_megabas(stack, 0)
-        last_watchdog = now
-        return True
+            for signal_class in sorted(set(plan[0] for plan in plans[cards[stack]])):
+                if (stack, signal_class) in cycles:
+                    cycles[(stack, signal_class)][5] = poll_interval(stack, signal_class)
+                else:
+                    # calls, overruns, seconds, longest, started, interval
+                    cycles[(stack, signal_class)] = [ 0, 0, 0.0, 0.0, 0.0, poll_interval(stack, signal_class) ]
+
+
+def metric_count(key, number=1):
+    with metrics_lock:
+        counters[key] += number
+
+
+def metric_time(label, function, elapsed, error):
+    with metrics_lock:
+        entry = timings.get((label, function))
+        if entry is None:
+            # calls, errors, seconds, longest, histogram buckets with the overflow last
+            entry = timings[(label, function)] = [ 0, 0, 0.0, 0.0, [ 0 ] * (len(METRIC_BUCKETS) + 1) ]
+        entry[0] += 1
+        entry[1] += error
+        entry[2] += elapsed
+        entry[3] = max(entry[3], elapsed)
+        entry[4][bisect.bisect_left(METRIC_BUCKETS, elapsed)] += 1
+
+
+def metric_task(task, args, start, error):
+    # card tasks take the stack first, read plans are accounted to their bulk reader
+    elapsed = time.perf_counter() - start
+    if task is get_plan:
+        function = args[1][1].__name__
     else:
-        return False
+        function = task.__name__
+    if args and args[0] in cards:
+        metric_time(card_label(args[0]), function, elapsed, error)
+    else:
+        metric_time("bridge", function, elapsed, error)
+
+
+def metric_cycle_start(stack, signal_class):
+    with metrics_lock:
+        entry = cycles.get((stack, signal_class))
+        if entry and not entry[4]:
+            entry[4] = time.perf_counter()
+
+
+def metric_cycle_reset(stack):
+    # a failed card leaves its cycles unfinished, start them over on the next poll
+    with metrics_lock:
+        for key in cycles:
+            if key[0] == stack:
+                cycles[key][4] = 0.0
+
+
+def metric_cycle(stack, signal_class):
+    # a poll cycle ends when the last queued chunk of the signal class is read, it overruns past its interval
+    with metrics_lock:
+        entry = cycles.get((stack, signal_class))
+        if entry and entry[4]:
+            elapsed = time.perf_counter() - entry[4]
+            entry[0] += 1
+            entry[1] += elapsed > entry[5]
+            entry[2] += elapsed
+            entry[3] = max(entry[3], elapsed)
+            entry[4] = 0.0
+
+
+def metrics_state():
+    functions = {}
+    polls = {}
+    with metrics_lock:
+        for (label, function), ( calls, errors, seconds, longest, buckets ) in sorted(timings.items()):
+            functions.setdefault(label, {})[function] = {
+                "calls": calls,
+                "errors": errors,
+                "avg_ms": round(seconds / calls * 1000, 3),
+                "max_ms": round(longest * 1000, 3),
+                "histogram_ms": dict(zip([ '%g' % (bucket * 1000) for bucket in METRIC_BUCKETS ] + [ "inf" ], buckets)),
+            }
+        for (stack, signal_class), ( calls, overruns, seconds, longest, started, interval ) in sorted(cycles.items()):
+            if calls:
+                polls.setdefault(card_label(stack), {})[signal_class] = {
+                    "cycles": calls,
+                    "overruns": overruns,
+                    "avg_ms": round(seconds / calls * 1000, 3),
+                    "max_ms": round(longest * 1000, 3),
+                }
+        events = dict(counters)
+    queues = { str(bus): workers[bus]["queue"].qsize() for bus in workers }
+    failing = { card_label(stack): degraded[stack][0] for stack in list(degraded) }
+    return { "functions": functions, "cycles": polls, "counters": events, "queues": queues, "degraded": failing }
+
+
+def metrics_publish():
+    client.publish(settings["topic"] + '/tele/METRICS', json.dumps(metrics_state()), qos)
+    metric_count('publish/metrics')
+
+
+def metrics_text():
+    # Prometheus text exposition of the same metrics
+    lines = []
+    with metrics_lock:
+        for (label, function), ( calls, errors, seconds, longest, buckets ) in sorted(timings.items()):
+            labels = 'card="' + label + '",function="' + function + '"'
+            total = 0
+            for bucket, count in zip([ str(bucket) for bucket in METRIC_BUCKETS ] + [ "+Inf" ], buckets):
+                total += count
+                lines.append('sequent_function_seconds_bucket{' + labels + ',le="' + bucket + '"} ' + str(total))
+            lines.append('sequent_function_seconds_sum{' + labels + '} ' + repr(seconds))
+            lines.append('sequent_function_seconds_count{' + labels + '} ' + str(calls))
+            lines.append('sequent_function_errors_total{' + labels + '} ' + str(errors))
+        for (stack, signal_class), ( calls, overruns, seconds, longest, started, interval ) in sorted(cycles.items()):
+            labels = 'card="' + card_label(stack) + '",class="' + signal_class + '"'
+            lines.append('sequent_cycle_seconds_sum{' + labels + '} ' + repr(seconds))
+            lines.append('sequent_cycle_seconds_count{' + labels + '} ' + str(calls))
+            lines.append('sequent_cycle_overruns_total{' + labels + '} ' + str(overruns))
+        for key, count in sorted(counters.items()):
+            kind, name = key.split('/', 1)
+            lines.append('sequent_' + kind + '_total{name="' + name + '"} ' + str(count))
+    for stack in cards.keys():
+        lines.append('sequent_card_degraded{card="' + card_label(stack) + '"} ' + str(int(stack in degraded)))
+    for bus in workers:
+        lines.append('sequent_queue_depth{bus="' + str(bus) + '"} ' + str(workers[bus]["queue"].qsize()))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    "Serves the metrics as Prometheus text"
+
+    def do_GET(self):
+        body = metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def metrics_serve():
+    if settings["metrics_port"]:
+        server = http.server.ThreadingHTTPServer(( settings["metrics_bind"], settings["metrics_port"] ), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def modbus_unit(stack):
+    # 8 unit ids per bus, the default bus 1 takes 1-8 and bus 0 swaps in for it with 9-16, so every bus has its own block
+    bus = { 0: 1, 1: 0 }.get(stack[0], stack[0])
+    return 8 * bus + stack[1] + 1
+
+
+def modbus_init():
+    # one unit per card, its channels in the order of the card banks: on/off responses are coils, on/off inputs
+    # discrete inputs, other responses holding and other inputs input registers, two registers per channel,
+    # float32 for analog values and uint32 for counters, high word first
+    global modbus_units
+    if not settings["modbus_port"]:
+        return
+    units = {}
+    for stack in sorted(cards.keys()):
+        unit = modbus_unit(stack)
+        if not 1 <= unit <= 247:
+            print("Card " + card_label(stack) + " has no Modbus unit id, buses above 29 have none")
+            continue
+        table = { "stack": stack, "coils": [], "discrete": [], "holding": [], "input": [] }
+        for io, signal, channels, integer in banks[cards[stack]]:
+            if integer and signal not in counter_bits:
+                kind = "coils" if io == "response" else "discrete"
+            else:
+                kind = "holding" if io == "response" else "input"
+            for channel in range(1, channels + 1):
+                topic = settings["topic"] + '/' + card_label(stack) + '/output/' + signal + '/' + str(channel)
+                table[kind].append(( card_slot(stack, io, signal, channel), topic, '>I' if signal in counter_bits else '>f' ))
+        units[unit] = table
+    modbus_units = units
+
+
+def modbus_bits(entries, start, count):
+    data = bytearray((count + 7) // 8)
+    for index in range(count):
+        if cache[entries[start + index][0]]:
+            data[index // 8] |= 1 << (index % 8)
+    return bytes(( len(data), )) + data
+
+
+def modbus_registers(entries, start, count):
+    data = b''.join(struct.pack(encoding, int(cache[slot]) & 0xffffffff if encoding == '>I' else cache[slot]) for slot, topic, encoding in entries[start // 2:(start + count + 1) // 2])
+    data = data[start % 2 * 2:start % 2 * 2 + count * 2]
+    return bytes(( len(data), )) + data
+
+
+def modbus_check(topic, value):
+    # exception code of a write, the same checks as for an MQTT command to the output topic
+    route = routes.get(topic)
+    if route is None or route[0] not in ( "output", "bank" ):
+        return 2
+    if not route[-1](value):
+        return 3
+    return 0
+
+
+def modbus_value(word):
+    # float32 of a holding register pair back to the value an MQTT payload would give
+    value = float('%.7g' % struct.unpack('>f', word)[0])
+    return int(value) if value.is_integer() else value
+
+
+def modbus_request(unit, pdu):
+    # one request PDU to its reply PDU, reads come from the cache, writes are queued like MQTT commands
+    function = pdu[0]
+    table = modbus_units.get(unit)
+    if table is None:
+        return bytes(( function | 0x80, 0x0b ))
+    if len(pdu) < 5 or function not in ( 1, 2, 3, 4, 5, 15, 16 ):
+        return bytes(( function | 0x80, 0x01 ))
+    start, count = struct.unpack_from('>HH', pdu, 1)
+    if function in ( 1, 2, 3, 4 ):
+        kind = ( None, "coils", "discrete", "holding", "input" )[function]
+        size = len(table[kind]) * (2 if function > 2 else 1)
+        if not 1 <= count <= (2000 if function <= 2 else 125):
+            return bytes(( function | 0x80, 0x03 ))
+        if start + count > size:
+            return bytes(( function | 0x80, 0x02 ))
+        if table["stack"] in degraded:
+            return bytes(( function | 0x80, 0x04 ))
+        metric_count('modbus/read')
+        if function <= 2:
+            return bytes(( function, )) + modbus_bits(table[kind], start, count)
+        return bytes(( function, )) + modbus_registers(table[kind], start, count)
+    if function == 5:
+        values = { start: { 0xff00: 1, 0x0000: 0 }.get(count) }
+        entries = table["coils"]
+        reply = pdu[:5]
+        if values[start] is None:
+            return bytes(( function | 0x80, 0x03 ))
+    elif function == 15:
+        entries = table["coils"]
+        reply = pdu[:5]
+        if not 1 <= count <= 1968 or len(pdu) < 6 + (count + 7) // 8:
+            return bytes(( function | 0x80, 0x03 ))
+        values = { start + index: pdu[6 + index // 8] >> (index % 8) & 1 for index in range(count) }
+    else:
+        # a holding register pair is one channel and is only written whole
+        entries = table["holding"]
+        reply = pdu[:5]
+        if not 1 <= count <= 123 or len(pdu) < 6 + count * 2:
+            return bytes(( function | 0x80, 0x03 ))
+        if start % 2 or count % 2:
+            return bytes(( function | 0x80, 0x02 ))
+        values = { start // 2 + index: modbus_value(pdu[6 + index * 4:10 + index * 4]) for index in range(count // 2) }
+        start //= 2
+        count //= 2
+    if start + len(values) > len(entries):
+        return bytes(( function | 0x80, 0x02 ))
+    # every value is checked before any is queued, a rejected request changes nothing
+    for index, value in values.items():
+        code = modbus_check(entries[index][1], value)
+        if code:
+            metric_count('errors/modbus')
+            return bytes(( function | 0x80, code ))
+    for index, value in values.items():
+        command_put(entries[index][1], value)
+    metric_count('modbus/write')
+    return reply
+
+
+def modbus_recv(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    "Serves one Modbus TCP client connection"
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                header = modbus_recv(self.request, 7)
+                if header is None:
+                    return
+                transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+                if protocol != 0 or not 2 <= length <= 254:
+                    return
+                pdu = modbus_recv(self.request, length - 1)
+                if pdu is None:
+                    return
+                reply = modbus_request(unit, pdu)
+                self.request.sendall(struct.pack('>HHHB', transaction, 0, len(reply) + 1, unit) + reply)
+        except OSError:
+            pass
+
+
+class ModbusServer(socketserver.ThreadingTCPServer):
+    "Modbus TCP server, a thread per client connection"
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def modbus_serve():
+    if settings["modbus_port"]:
+        server = ModbusServer(( settings["modbus_bind"], settings["modbus_port"] ), ModbusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
 
 
 def check_heartbeat(mode):
@@ -566,16 +2507,13 @@ def check_heartbeat(mode):
     now = int(time.time())
     if mode == 1:
         last_heartbeat = now
-        client.publish(config['MQTT']['TOPIC'] + '/' + config['HEARTBEAT']['TOPIC_RESPONSE'], str(now), int(config['MQTT']['QOS']))
+        client.publish(settings["topic"] + '/' + settings["heartbeat_response"], str(now), qos)
+        metric_count('publish/heartbeat')
         return True
-    elif int(config['HEARTBEAT']['TIMEOUT']) > 0 and last_heartbeat >= 0 and now - last_heartbeat > int(config['HEARTBEAT']['TIMEOUT']):
+    elif settings["heartbeat_timeout"] > 0 and last_heartbeat >= 0 and now - last_heartbeat > settings["heartbeat_timeout"]:
         for stack in cards.keys():
-            if cards[stack] == "megaind":
-                reset_megaind(stack)
-            elif cards[stack] == "megabas":
-                reset_megabas(stack)
-            elif cards[stack] == "8relind":
-                reset_8relind(stack)
+            if cards[stack] in resets:
+                card_put(stack, PRIORITY_SAFETY, resets[cards[stack]], stack)
         last_heartbeat = -1
         return False
     else:
@@ -600,122 +2538,466 @@ def on_connect(client, userdata, flags, rc):
     else:
         print('MQTT client connected')
         client.connected_flag = 1
+        runtime_wake()
 
 
 def on_disconnect(client, userdata, rc):
     client.connected_flag = 0
+    runtime_wake()
     if rc != 0:
         print('MQTT unexpected disconnect return code ' + str(rc))
         print('MQTT client disconnected')
 
 
+def parse_value(payload):
+    # single pass over the raw payload, accepts unsigned integers and decimals like "1" or "3.5"
+    if payload.isdigit():
+        return int(payload)
+    whole, dot, fraction = payload.partition(b'.')
+    if dot and whole.isdigit() and fraction.isdigit():
+        return float(payload)
+    return None
+
+
+def write_mode(output):
+    # MODE_<OUTPUT> wins over the MODE default: verified, optimistic or fire
+    if 'OUTPUT' in config:
+        for key in ( 'MODE_' + output, 'MODE' ):
+            if config['OUTPUT'].get(key):
+                if config['OUTPUT'][key] not in [ 'verified', 'optimistic', 'fire' ]:
+                    raise AppError("Invalid config entry OUTPUT/" + key + ", use verified, optimistic or fire")
+                return config['OUTPUT'][key]
+    return "verified"
+
+
+def routes_init():
+    # map every subscribed command topic straight to its handler and prebound arguments,
+    # the table is swapped in whole so a config reload never shows a half built one
+    global routes
+    table = {}
+    table[settings["topic"] + '/tele/cmnd/state'] = ( "tele", )
+    table[settings["topic"] + '/' + settings["heartbeat_challenge"]] = ( "heartbeat", )
+    for stack in cards.keys():
+        if cards[stack] in outputs:
+            setter, card_outputs = outputs[cards[stack]]
+            for output, ( channels, validator ) in card_outputs.items():
+                write_modes[(stack, output)] = write_mode(output)
+                prefix = settings["topic"] + '/' + card_label(stack) + '/output/' + output
+                if output in output_banks.get(cards[stack], {}):
+                    table[prefix] = ( "bulk", stack, output, channels )
+                    for channel in range(1, channels + 1):
+                        table[prefix + '/' + str(channel)] = ( "bank", stack, output, channel, validator )
+                else:
+                    for channel in range(1, channels + 1):
+                        table[prefix + '/' + str(channel)] = ( "output", setter, stack, output, channel, validator )
+    for slot in history:
+        io, signal, channel = slot_keys[slot]
+        table[settings["topic"] + '/' + card_label(slot_stacks[slot]) + '/stats/' + signal + '/' + channel] = ( "stats", slot )
+    routes = table
+
+
+def command_put(topic, value):
+    # a checked command to an output topic from inside the bridge, queued the same way as one from MQTT
+    route = routes[topic]
+    if route[0] == "bank":
+        kind, stack, output, channel, validator = route
+        bank_put(stack, output, { channel: value })
+    else:
+        kind, setter, stack, output, channel, validator = route
+        card_put(stack, PRIORITY_COMMAND, setter, stack, output, channel, value)
+
+
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
-    tele = re.match(r'^' + config['MQTT']['TOPIC'] + '\/tele/cmnd\/(state)$', str(msg.topic))
-    megaind = re.match(r'^' + config['MQTT']['TOPIC'] + '\/megaind\/([0-7])\/output\/(0_10|4_20|pwm|led|opto_rce|opto_fce|opto_rst)\/([1-8])$', str(msg.topic))
-    megabas = re.match(r'^' + config['MQTT']['TOPIC'] + '\/megabas\/([0-7])\/output\/(0_10|triac|opto_rce|opto_fce)\/([1-8])$', str(msg.topic))
-    relind8 = re.match(r'^' + config['MQTT']['TOPIC'] + '\/8relind\/([0-7])\/output\/(relay)/([1-8])$', str(msg.topic))
-    heartbeat = re.match(r'^' + config['MQTT']['TOPIC'] + '\/' + config['HEARTBEAT']['TOPIC_CHALLENGE'] + '$', str(msg.topic))
-    
-    if tele:
-        topic = tele.group(1)
-        payload = str(msg.payload.decode("utf-8"))
-        if topic == "state" and payload == "":
-            cards_update(1)
-    elif heartbeat:
-        check_heartbeat(1)
-    else:
-        value = msg.payload.decode("utf-8")
-        value_i = re.match(r'^(\d+)$', msg.payload.decode("utf-8"))
-        value_f = re.match(r'^(\d+\.\d+)$', msg.payload.decode("utf-8"))
-        if value_i:
-            value = int(value_i.group(1))
-        elif value_f:
-            value = float(value_f.group(1))
+    route = routes.get(msg.topic)
+    if route is None:
+        command_error(msg.topic, msg.payload, 'Unknown MQTT topic')
+    elif route[0] == "output":
+        kind, setter, stack, output, channel, validator = route
+        value = parse_value(msg.payload)
+        if value is None:
+            command_error(msg.topic, msg.payload, 'Unknown MQTT value')
+        elif not validator(value):
+            command_error(msg.topic, msg.payload, "Can't set " + cards[stack] + " stack: " + card_stack(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(value))
         else:
-            raise AppError('Unknown MQTT value: ' + str(msg.topic) + ', Message: ' + str(value))
-            return False
-        if megaind:
-            stack = int(megaind.group(1))
-            output = megaind.group(2)
-            channel = int(megaind.group(3))
-            set_megaind(stack, output, channel, value)
-        elif megabas:
-            stack = int(megabas.group(1))
-            output = megabas.group(2)
-            channel = int(megabas.group(3))
-            set_megabas(stack, output, channel, value)
-        elif relind8:
-            stack = int(relind8.group(1))
-            output = relind8.group(2)
-            channel = int(relind8.group(3))
-            set_8relind(stack, output, channel, value)
+            card_put(stack, PRIORITY_COMMAND, setter, stack, output, channel, value)
+    elif route[0] == "bank":
+        kind, stack, output, channel, validator = route
+        value = parse_value(msg.payload)
+        if value is None or not validator(value):
+            command_error(msg.topic, msg.payload, "Can't set " + cards[stack] + " stack: " + card_stack(stack) + ", topic: " + output + ", channel: " + str(channel) + " to value: " + str(msg.payload))
+        else:
+            bank_put(stack, output, { channel: value })
+    elif route[0] == "bulk":
+        kind, stack, output, channels = route
+        values = parse_bank(msg.payload, channels)
+        if not values:
+            command_error(msg.topic, msg.payload, 'Unknown MQTT value, use a bitmask, JSON array or JSON map')
         else:
-            raise AppError('Unknown MQTT topic: ' + str(msg.topic) + ', Message: ' + str(value))
+            bank_put(stack, output, values)
+    elif route[0] == "stats":
+        kind, slot = route
+        request = stats_request(msg.payload)
+        if request is None:
+            command_error(msg.topic, msg.payload, 'Unknown stats request, use a window in seconds or {"window": 60, "percentiles": [ 50, 95 ]}')
+        else:
+            client.publish(msg.topic + '/result', json.dumps(history_stats(slot, *request)), qos)
+            metric_count('publish/stats')
+    elif route[0] == "heartbeat":
+        check_heartbeat(1)
+    elif route[0] == "tele" and msg.payload == b"":
+        cards_update()
 
 
 # Add connection flags
 mqtt.Client.connected_flag = 0
 mqtt.Client.reconnect_count = 0
 
-# Imain loop
-last_heartbeat = int(time.time())
-while True:
+
+def settings_check(fresh, fresh_cards):
+    # dry run of the per channel sections so a bad entry rejects the reload before anything changed
+    if 'RULES' in fresh:
+        for name in fresh['RULES']:
+            if fresh['RULES'].get(name, raw=True):
+                rule_parse(name, fresh['RULES'].get(name, raw=True), fresh_cards)
+    for section, parse in ( ( 'FILTER', filter_parse ), ( 'HISTORY', history_parse ), ( 'RATE', rate_parse ) ):
+        if section in fresh:
+            for key in fresh[section]:
+                if fresh[section].get(key, raw=True):
+                    parse(key, fresh[section].get(key, raw=True))
+    if 'OUTPUT' in fresh:
+        for key in fresh['OUTPUT']:
+            if key.upper().startswith('MODE') and fresh['OUTPUT'][key] not in [ 'verified', 'optimistic', 'fire' ]:
+                raise AppError("Invalid config entry OUTPUT/" + key.upper() + ", use verified, optimistic or fire")
+
+
+def card_remove(stack):
+    # stop a card dropped from the config, its cache slots stay allocated but nothing refers to them anymore
+    card_unsubscribe(stack)
+    card_status(stack, "removed")
+    unread.pop(stack, None)
+    for slot in range(len(slot_stacks)):
+        if slot_stacks[slot] == stack:
+            history.pop(slot, None)
+            rates.pop(slot, None)
+            filters.pop(slot, None)
+            expected.pop(slot, None)
+            readback.discard(slot)
+            journaled.discard(slot)
+            summarized.discard(slot)
+            rate_only.discard(slot)
+            unsent.discard(slot)
+            export_remove(slot)
+    for table in ( summaries, rate_groups ):
+        for interval in list(table):
+            table[interval] = [ slot for slot in table[interval] if slot_stacks[slot] != stack ]
+            if not table[interval]:
+                del table[interval]
+    for start in slots[stack].values():
+        recorded.discard(start)
+        rated.discard(start)
+        filtered.discard(start)
+    for plan in plans[cards[stack]]:
+        bindings.pop((stack, plan), None)
+    del slots[stack]
+    print("Card " + card_label(stack) + " removed")
+    for table in ( changes, state_topics, drivers, health, degraded ):
+        table.pop(stack, None)
+
+
+def settings_reload():
+    # SIGHUP: re-read the config and apply what changed, only the cards added or removed are touched
+    global config, settings, cards, reload_pending
+    reload_pending = False
+    fresh = configparser.ConfigParser()
+    fresh.read(config_path)
+    loaded = {}
     try:
-        # Init counters
-        last_tele = 0
-        last_watchdog = 0
-        # Heartbeat check
-        check_heartbeat(0)
-        # Create mqtt client
-        client = mqtt.Client()
-        client.connected_flag = 0
-        client.reconnect_count = 0
-        # Register LWT message
-        client.will_set(config['MQTT']['TOPIC'] + '/tele/LWT', payload="Offline", qos=0, retain=True)
-        # Register connect callback
-        client.on_connect = on_connect
-        # Register disconnect callback
-        client.on_disconnect = on_disconnect
-        # Registed publish message callback
-        client.on_message = on_message
-        # Set access token
-        client.username_pw_set(config['MQTT']['USER'], config['MQTT']['PASS'])
-        # Run receive thread
-        client.loop_start()
-        # Connect to broker
-        client.connect(config['MQTT']['SERVER'], int(config['MQTT']['PORT']), int(config['MQTT']['TIMEOUT']))
-        time.sleep(1)
-        while not client.connected_flag:
-            print("MQTT waiting to connect")
-            client.reconnect_count += 1
-            if client.reconnect_count > 10:
-                raise AppError("MQTT restarting connection!")
-            time.sleep(1)
-        # Sent LWT update
-        client.publish(config['MQTT']['TOPIC'] + '/tele/LWT',payload="Online", qos=0, retain=True)
-        # init cards inputs and subscribe for output topics
-        cards_init()
-        # Run sending thread
-        while True:
+        new = settings_parse(fresh)
+        settings_check(fresh, new["cards"])
+        for stack, card in new["cards"].items():
+            if cards.get(stack) != card:
+                loaded[stack] = driver_load(stack, card)
+    except AppError as error:
+        print("Config reload rejected:", error)
+        return
+    for key in ( "topic", "server", "port", "timeout", "user", "pass", "client_id", "state", "session", "runtime", "metrics_port", "metrics_bind", "journal_path", "journal_classes", "shared_path", "watchdog_realtime", "modbus_port", "modbus_bind" ):
+        if new[key] != settings[key]:
+            print("Config entry " + key + " changes on restart only")
+            new[key] = settings[key]
+    removed = [ stack for stack in cards.keys() if new["cards"].get(stack) != cards[stack] ]
+    added = [ stack for stack in new["cards"].keys() if cards.get(stack) != new["cards"][stack] ]
+    for stack in removed:
+        card_remove(stack)
+    stats = set(slot_stacks[slot] for slot in history)
+    previous = settings
+    config = fresh
+    settings = new
+    settings_globals()
+    cards = dict(new["cards"])
+    drivers.update(loaded)
+    layout_init()
+    export_layout()
+    filters.clear()
+    filtered.clear()
+    filters_init()
+    history_reload()
+    rate_reload()
+    if journal is not None:
+        journal_slots()
+    metrics_init()
+    routes_init()
+    modbus_init()
+    rules_init()
+    worker_start()
+    if previous["qos"] != qos or previous["heartbeat_challenge"] != settings["heartbeat_challenge"]:
+        client.unsubscribe(settings["topic"] + '/' + previous["heartbeat_challenge"])
+        client.subscribe(settings["topic"] + '/' + settings["heartbeat_challenge"], qos)
+    if previous["qos"] != qos:
+        client.subscribe(settings["topic"] + '/tele/cmnd/+', qos)
+        for stack in cards.keys():
+            if stack not in added:
+                card_subscribe(stack)
+    for stack in cards.keys():
+        # stats requests of running cards follow their HISTORY entries
+        if stack in added:
+            continue
+        if stack not in stats and any(slot_stacks[slot] == stack for slot in history):
+            client.subscribe(settings["topic"] + '/' + card_label(stack) + '/stats/+/+', qos)
+        elif stack in stats and not any(slot_stacks[slot] == stack for slot in history):
+            client.unsubscribe(settings["topic"] + '/' + card_label(stack) + '/stats/+/+')
+    watchdog = any(previous[key] != settings[key] for key in ( "watchdog_timeout", "watchdog_boot", "watchdog_reset" ))
+    for stack in cards.keys():
+        if stack in added:
+            card_init(stack, 1)
+        elif watchdog and cards[stack] in watchdogs:
+            health.pop(stack, None)
+            card_put(stack, PRIORITY_HEALTH, watchdogs[cards[stack]], stack, 1)
+    schedule_init()
+    print("Config reloaded, cards added: " + str(len(added)) + ", removed: " + str(len(removed)))
+
+
+def settings_signal(*args):
+    # applied by the main loop, not inside the signal handler
+    global reload_pending
+    reload_pending = True
+    runtime_wake()
+
+
+def mqtt_init():
+    # Create mqtt client, a persistent session needs the stable client id
+    client = mqtt.Client(client_id=settings["client_id"], clean_session=(session == 'clean'))
+    client.connected_flag = 0
+    client.reconnect_count = 0
+    # Register LWT message
+    client.will_set(settings["topic"] + '/tele/LWT', payload="Offline", qos=0, retain=True)
+    # Register connect callback
+    client.on_connect = on_connect
+    # Register disconnect callback
+    client.on_disconnect = on_disconnect
+    # Registed publish message callback
+    client.on_message = on_message
+    # Set access token
+    client.username_pw_set(settings["user"], settings["pass"])
+    return client
+
+
+def service_init():
+    global last_heartbeat
+    startup["config"] = startup_config
+    last_heartbeat = int(time.time())
+    layout_init()
+    export_layout()
+    filters_init()
+    history_init()
+    rates_init()
+    journal_init()
+    metrics_init()
+    # routes first, a persistent session may deliver queued commands right after connect
+    routes_init()
+    modbus_init()
+    rules_init()
+    metrics_serve()
+    modbus_serve()
+    worker_start()
+    startup_mark("service")
+    # ready without waiting for the broker, an unreachable broker at boot must not time out the unit
+    systemd_notify("READY=1\nSTATUS=Connecting to the broker")
+
+
+def service_start():
+    global synced
+    if not synced:
+        startup_mark("connected")
+    # Sent LWT update
+    client.publish(settings["topic"] + '/tele/LWT',payload="Online", qos=0, retain=True)
+    # init cards inputs and subscribe for output topics
+    cards_init()
+    schedule_init()
+    if not synced:
+        safety_start()
+    synced = True
+    journal_start()
+
+
+def schedule_idle():
+    # with the journal or rules on, the cards are polled during broker outages so they see every change,
+    # watchdog and heartbeat stay stopped as before
+    if ( journal is None and not rules ) or not synced:
+        return 5.0
+    try:
+        return schedule_run(( get_card, ))
+    except Exception as error:
+        print("An exception occurred:", type(error).__name__, "–", error)
+        return 1.0
+
+
+def schedule_sleep(seconds, until=None):
+    # until: ends the sleep early once true, checked every 20 ms
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        if until is not None and until():
+            return
+        time.sleep(max(0, min(end - time.monotonic(), schedule_idle(), 0.02 if until is not None else end)))
+
+
+def runtime_wake():
+    # cut the asyncio runtime wait short, called from paho callbacks
+    if wake is not None:
+        wake_loop.call_soon_threadsafe(wake.set)
+
+
+def socket_watch(client, sock, method, *args):
+    # deferred selector change, dropped when the socket was closed in the meantime
+    if client.socket() is sock:
+        method(sock, *args)
+
+
+def mqtt_attach(client):
+    # the asyncio loop drives the paho socket instead of the loop_start thread, publishes may come from any thread
+    client.on_socket_open = lambda client, userdata, sock: wake_loop.call_soon_threadsafe(socket_watch, client, sock, wake_loop.add_reader, client.loop_read)
+    client.on_socket_close = lambda client, userdata, sock: ( wake_loop.remove_reader(sock), wake_loop.remove_writer(sock) )
+    client.on_socket_register_write = lambda client, userdata, sock: wake_loop.call_soon_threadsafe(socket_watch, client, sock, wake_loop.add_writer, client.loop_write)
+    client.on_socket_unregister_write = lambda client, userdata, sock: wake_loop.call_soon_threadsafe(socket_watch, client, sock, wake_loop.remove_writer)
+
+
+async def mqtt_misc(client):
+    # keepalive and retry housekeeping normally done by the paho network thread
+    while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+        await asyncio.sleep(1)
+
+
+async def runtime_wait(delay):
+    wake.clear()
+    try:
+        await asyncio.wait_for(wake.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+# Main loop
+def main():
+    global client
+    service_init()
+    signal.signal(signal.SIGHUP, settings_signal)
+    while True:
+        try:
+            # Heartbeat check
+            check_heartbeat(0)
+            client = mqtt_init()
+            # Connect to broker, before the receive thread starts so it does not wait out a reconnect delay first
+            client.connect(settings["server"], settings["port"], settings["timeout"])
+            # Run receive thread
+            client.loop_start()
+            schedule_sleep(1, lambda: client.connected_flag)
+            while not client.connected_flag:
+                print("MQTT waiting to connect")
+                client.reconnect_count += 1
+                if client.reconnect_count > 10:
+                    raise AppError("MQTT restarting connection!")
+                schedule_sleep(1, lambda: client.connected_flag)
+            service_start()
+            # Run sending thread
+            while True:
+                if client.connected_flag:
+                    safety_check()
+                    if reload_pending:
+                        settings_reload()
+                    delay = schedule_run()
+                else:
+                    raise AppError("MQTT connection lost!")
+                # at most a second so a heartbeat loss seen by the safety thread restarts the connection in time
+                time.sleep(min(delay, 1))
+        except BaseException as error:
+            print("An exception occurred:", type(error).__name__, "–", error)
+            client.loop_stop()
             if client.connected_flag:
-                cards_update(0)
-                cards_watchdog()
-                if not check_heartbeat(0):
-                    raise AppError("Missing heartbeat, all cards outputs reseted!")
+                cards_unsubscribe()
+                client.disconnect()
+            if type(error) in [ KeyboardInterrupt, SystemExit ]:
+                # Gracefull shutwdown
+                sys.exit(0)
             else:
-                raise AppError("MQTT connection lost!")
-            time.sleep(1)
-    except BaseException as error:
-        print("An exception occurred:", type(error).__name__, "–", error)
-        client.loop_stop()
-        if client.connected_flag:
-            cards_unsubscribe()
-            client.disconnect()
-        del client
-        if type(error) in [ KeyboardInterrupt, SystemExit ]:
-            # Gracefull shutwdown
-            sys.exit(0)
-        else:
-            #Restart connection
-            time.sleep(5)
+                #Restart connection
+                schedule_sleep(5)
+
+
+# Main loop on asyncio, MQTT socket I/O, scheduler and wakeups share one event loop, card I/O stays on the bus workers
+async def main_async():
+    global client, wake, wake_loop
+    wake_loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    service_init()
+    wake_loop.add_signal_handler(signal.SIGHUP, settings_signal)
+    while True:
+        misc = None
+        try:
+            # Heartbeat check
+            check_heartbeat(0)
+            client = mqtt_init()
+            mqtt_attach(client)
+            # Connect to broker, name resolution and TCP connect block so they go to the default executor
+            await wake_loop.run_in_executor(None, client.connect, settings["server"], settings["port"], settings["timeout"])
+            misc = wake_loop.create_task(mqtt_misc(client))
+            deadline = time.monotonic() + 10
+            while not client.connected_flag:
+                if time.monotonic() >= deadline:
+                    raise AppError("MQTT restarting connection!")
+                await runtime_wait(deadline - time.monotonic())
+            service_start()
+            while True:
+                if client.connected_flag:
+                    safety_check()
+                    if reload_pending:
+                        settings_reload()
+                    delay = schedule_run()
+                else:
+                    raise AppError("MQTT connection lost!")
+                await runtime_wait(delay)
+        except BaseException as error:
+            print("An exception occurred:", type(error).__name__, "–", error)
+            if misc:
+                misc.cancel()
+            if client.connected_flag:
+                cards_unsubscribe()
+                client.disconnect()
+                client.loop_write()
+            if type(error) in [ KeyboardInterrupt, SystemExit, asyncio.CancelledError ]:
+                # Gracefull shutwdown
+                return
+            else:
+                #Restart connection
+                end = time.monotonic() + 5
+                while time.monotonic() < end:
+                    await asyncio.sleep(max(0, min(end - time.monotonic(), schedule_idle())))
+
+
+if __name__ == '__main__':
+    if runtime == "asyncio":
+        try:
+            asyncio.run(main_async())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    else:
+        main()
@@ -0,0 +1,136 @@
+"""Reader of the shared memory state exported by sequent-mqtt.py.
+
+With [SHARED] PATH set (e.g. /dev/shm/sequent-mqtt) the bridge keeps the
+current value of every channel in a memory mapped file, so local processes
+read card state without a broker round trip and without touching the I2C bus.
+
+Layout version 1, all fields little endian:
+
+    header, 64 bytes
+      0  4s  magic b'SQMQ'
+      4  H   layout version (1)
+      6  H   header size (64)
+      8  I   slots in use
+     12  I   slot capacity of the file
+     16  I   record size (24)
+     20  I   records offset
+     24  I   directory offset
+     28  I   directory length in bytes
+     32  I   generation, odd while the directory changes, 0xffffffff once the
+             file was replaced by a bigger one and has to be opened again
+     36  I   reserved
+     40  d   unix time of the last finished poll
+
+    record per slot, 24 bytes at records offset + slot * record size
+      0  I   sequence, odd while the record is written, +2 on every update
+      4  I   flags, bit 0 integer value, bit 1 value valid
+      8  d   value
+     16  d   unix time of the last change
+
+    directory: JSON list of slot names at directory offset, the topics
+    without the TOPIC prefix, e.g. "megabas/0/input/0_10/3"
+
+Readers never lock. A record is consistent when its sequence was even and
+the same before and after the value was copied (seqlock), otherwise it is
+read again. The directory is read the same way using the generation.
+
+    reader = Reader('/dev/shm/sequent-mqtt')
+    value, changed = reader.read('megabas/0/input/0_10/3')
+    state = reader.snapshot()
+
+    python3 sequent_shared.py /dev/shm/sequent-mqtt
+"""
+
+import json
+import mmap
+import struct
+import sys
+import time
+
+MAGIC = b'SQMQ'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIIIIIId')
+RECORD = struct.Struct('<IIdd')
+SEQUENCE = struct.Struct('<I')
+MOVED = 0xffffffff
+
+
+class Reader:
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.generation = None
+        self.names = []
+        self.slots = {}
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.generation = None
+        self.refresh()
+
+    def header(self):
+        magic, version, header_size, count, capacity, record_size, records, directory, length, generation, reserved, updated = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version " + str(VERSION) + " sequent-mqtt export: " + self.path)
+        return count, records, record_size, directory, length, generation, updated
+
+    def refresh(self):
+        # reload the directory when the bridge changed the layout or replaced the file
+        while True:
+            count, records, record_size, directory, length, generation, updated = self.header()
+            if generation == MOVED:
+                self.open()
+                return
+            if generation == self.generation:
+                return
+            if generation % 2:
+                time.sleep(0)
+                continue
+            names = bytes(self.map[directory:directory + length])
+            if SEQUENCE.unpack_from(self.map, 32)[0] != generation:
+                continue
+            self.names = json.loads(names.decode('utf-8'))
+            self.slots = { name: slot for slot, name in enumerate(self.names) }
+            self.records = records
+            self.record_size = record_size
+            self.generation = generation
+            return
+
+    def record(self, slot):
+        # seqlock read, returns ( value, time of change ) or None for a channel without valid value
+        offset = self.records + slot * self.record_size
+        while True:
+            before = SEQUENCE.unpack_from(self.map, offset)[0]
+            if before % 2:
+                continue
+            sequence, flags, value, changed = RECORD.unpack_from(self.map, offset)
+            if SEQUENCE.unpack_from(self.map, offset)[0] == before == sequence:
+                break
+        if not flags & 2:
+            return None
+        return ( int(value) if flags & 1 else value, changed )
+
+    def read(self, name):
+        self.refresh()
+        return self.record(self.slots[name])
+
+    def updated(self):
+        return self.header()[6]
+
+    def snapshot(self):
+        self.refresh()
+        state = {}
+        for slot, name in enumerate(self.names):
+            entry = self.record(slot)
+            if entry is not None:
+                state[name] = entry
+        return state
+
+
+if __name__ == '__main__':
+    reader = Reader(sys.argv[1] if len(sys.argv) > 1 else '/dev/shm/sequent-mqtt')
+    print("last poll", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(reader.updated())))
+    for name, ( value, changed ) in sorted(reader.snapshot().items()):
+        print(name, value, time.strftime("%H:%M:%S", time.localtime(changed)))
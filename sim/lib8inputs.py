@@ -0,0 +1,23 @@
+"""Simulated 8inputs driver, API compatible with the Sequent Microsystems SM8inputs library."""
+
+import smbus2
+
+DEVICE_ADDRESS = 0x20
+RELAY4_INPORT_REG_ADD = 0x00
+
+
+def _read(stack):
+    if stack < 0 or stack > 7:
+        raise ValueError('Invalid stack level')
+    with smbus2.SMBus(1) as bus:
+        return bus.read_byte_data(DEVICE_ADDRESS + (0x07 ^ stack), RELAY4_INPORT_REG_ADD)
+
+
+def get_opto(stack, channel):
+    if channel < 1 or channel > 8:
+        raise ValueError('Invalid opto channel number')
+    return 1 if _read(stack) & (1 << (channel - 1)) else 0
+
+
+def get_opto_all(stack):
+    return _read(stack)
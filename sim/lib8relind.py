@@ -0,0 +1,51 @@
+"""Simulated 8relind driver, API compatible with the Sequent Microsystems SM8relind library."""
+
+import smbus2
+
+DEVICE_ADDRESS = 0x38
+RELAY8_INPORT_REG_ADD = 0x00
+RELAY8_OUTPORT_REG_ADD = 0x01
+
+
+def _address(stack):
+    if stack < 0 or stack > 7:
+        raise ValueError('Invalid stack level!')
+    return DEVICE_ADDRESS + (0x07 ^ stack)
+
+
+def _read(stack):
+    with smbus2.SMBus(1) as bus:
+        return bus.read_byte_data(_address(stack), RELAY8_INPORT_REG_ADD)
+
+
+def _write(stack, value):
+    with smbus2.SMBus(1) as bus:
+        # the simulated expander mirrors the output port on the input port
+        bus.write_byte_data(_address(stack), RELAY8_INPORT_REG_ADD, value)
+
+
+def set(stack, relay, value):
+    if relay < 1 or relay > 8:
+        raise ValueError('Invalid relay number!')
+    current = _read(stack)
+    if value:
+        current |= 1 << (relay - 1)
+    else:
+        current &= ~(1 << (relay - 1))
+    _write(stack, current & 0xff)
+
+
+def set_all(stack, value):
+    if value < 0 or value > 255:
+        raise ValueError('Invalid relay value!')
+    _write(stack, value)
+
+
+def get(stack, relay):
+    if relay < 1 or relay > 8:
+        raise ValueError('Invalid relay number!')
+    return 1 if _read(stack) & (1 << (relay - 1)) else 0
+
+
+def get_all(stack):
+    return _read(stack)
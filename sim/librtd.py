@@ -0,0 +1,18 @@
+"""Simulated rtd driver, API compatible with the Sequent Microsystems SMrtd library."""
+
+import struct
+import smbus2
+
+DEVICE_ADDRESS = 0x40
+RTD_TEMPERATURE_ADD = 0
+RTD_RESISTANCE_ADD = 59
+
+
+def get(stack, channel):
+    if stack < 0 or stack > 7:
+        raise ValueError('Invalid stack level')
+    if channel < 1 or channel > 8:
+        raise ValueError('Invalid channel number')
+    with smbus2.SMBus(1) as bus:
+        buff = bus.read_i2c_block_data(DEVICE_ADDRESS + stack, RTD_TEMPERATURE_ADD + 4 * (channel - 1), 4)
+    return struct.unpack('<f', bytearray(buff))[0]
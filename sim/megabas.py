@@ -0,0 +1,223 @@
+"""Simulated megabas driver, API compatible with the Sequent Microsystems SMmegabas library."""
+
+import smbus2
+
+BUS_NO = 1
+HW_ADD = 0x48
+
+TRIACS_VAL_ADD = 0
+TRIACS_SET_ADD = 1
+TRIACS_CLR_ADD = 2
+DRY_CONTACT_VAL_ADD = 3
+U0_10_OUT_VAL1_ADD = 4
+U0_10_IN_VAL1_ADD = 12
+R_1K_CH1 = 28
+R_10K_CH1 = 44
+I2C_MEM_WDT_RESET_ADD = 83
+I2C_MEM_WDT_INTERVAL_SET_ADD = 84
+I2C_MEM_WDT_INTERVAL_GET_ADD = 86
+I2C_MEM_WDT_INIT_INTERVAL_SET_ADD = 88
+I2C_MEM_WDT_INIT_INTERVAL_GET_ADD = 90
+I2C_MEM_WDT_RESET_COUNT_ADD = 92
+I2C_MEM_WDT_POWER_OFF_INTERVAL_SET_ADD = 95
+I2C_MEM_WDT_POWER_OFF_INTERVAL_GET_ADD = 99
+I2C_MEM_DRY_CONTACT_RISING_ENABLE = 103
+I2C_MEM_DRY_CONTACT_FALLING_ENABLE = 104
+DIAG_TEMPERATURE_MEM_ADD = 0x72
+DIAG_24V_MEM_ADD = 0x73
+DIAG_5V_MEM_ADD = 0x75
+REVISION_MAJOR_MEM_ADD = 0x7a
+REVISION_MINOR_MEM_ADD = 0x7b
+I2C_MEM_DRY_CONTACT_COUNTERS = 0x80
+RELOAD_KEY = 0xca
+
+
+def c2(val):
+    if val > 32768:
+        val = val - 65536
+    return val
+
+
+def checkStack(stack):
+    if stack < 0 or stack > 7:
+        raise ValueError('Invalid stack level [0..7]')
+
+
+def checkCh(ch, max):
+    if ch < 1 or ch > max:
+        raise ValueError('Invalid channel number')
+
+
+def _read_byte(stack, register):
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        return bus.read_byte_data(HW_ADD + stack, register)
+
+
+def _write_byte(stack, register, value):
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        bus.write_byte_data(HW_ADD + stack, register, value)
+
+
+def _read_word(stack, register):
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        return bus.read_word_data(HW_ADD + stack, register)
+
+
+def _write_word(stack, register, value):
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        bus.write_word_data(HW_ADD + stack, register, value)
+
+
+def getVer(stack):
+    return " Fw " + str(_read_byte(stack, REVISION_MAJOR_MEM_ADD)) + "." + str(_read_byte(stack, REVISION_MINOR_MEM_ADD))
+
+
+def setUOut(stack, ch, val):
+    checkCh(ch, 4)
+    if val < 0 or val > 10:
+        raise ValueError('Invalid value')
+    _write_word(stack, U0_10_OUT_VAL1_ADD + 2 * (ch - 1), int(val * 1000))
+    return 1
+
+
+def getUOut(stack, ch):
+    checkCh(ch, 4)
+    return c2(_read_word(stack, U0_10_OUT_VAL1_ADD + 2 * (ch - 1))) / 1000.0
+
+
+def getUIn(stack, ch):
+    checkCh(ch, 8)
+    return c2(_read_word(stack, U0_10_IN_VAL1_ADD + 2 * (ch - 1))) / 1000.0
+
+
+def getRIn1K(stack, ch):
+    checkCh(ch, 8)
+    return _read_word(stack, R_1K_CH1 + 2 * (ch - 1)) / 1000.0
+
+
+def getRIn10K(stack, ch):
+    checkCh(ch, 8)
+    return _read_word(stack, R_10K_CH1 + 2 * (ch - 1)) / 1000.0
+
+
+def getTriacs(stack):
+    return _read_byte(stack, TRIACS_VAL_ADD)
+
+
+def getTriac(stack, ch):
+    return _read_byte(stack, TRIACS_VAL_ADD) & (1 << (ch - 1))
+
+
+def setTriacs(stack, val):
+    _write_byte(stack, TRIACS_VAL_ADD, val)
+    return 1
+
+
+def setTriac(stack, ch, val):
+    checkCh(ch, 4)
+    _write_byte(stack, TRIACS_SET_ADD if val != 0 else TRIACS_CLR_ADD, ch)
+    return 1
+
+
+def getContact(stack):
+    return _read_byte(stack, DRY_CONTACT_VAL_ADD)
+
+
+def getContactCh(stack, ch):
+    checkCh(ch, 8)
+    return 1 if _read_byte(stack, DRY_CONTACT_VAL_ADD) & (1 << (ch - 1)) else 0
+
+
+def getContactCounter(stack, ch):
+    checkCh(ch, 8)
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        return int.from_bytes(bytes(bus.read_i2c_block_data(HW_ADD + stack, I2C_MEM_DRY_CONTACT_COUNTERS + (ch - 1) * 4, 4)), 'little')
+
+
+def getContactCountEdge(stack, ch):
+    checkCh(ch, 8)
+    val = 0
+    if _read_byte(stack, I2C_MEM_DRY_CONTACT_RISING_ENABLE) & (1 << (ch - 1)):
+        val += 1
+    if _read_byte(stack, I2C_MEM_DRY_CONTACT_FALLING_ENABLE) & (1 << (ch - 1)):
+        val += 2
+    return val
+
+
+def setContactCountEdge(stack, ch, edge):
+    checkCh(ch, 8)
+    if edge < 0 or edge > 3:
+        raise ValueError('Invalid edge type, 0 - none(disable counting), 1 - rising, 2 - falling, 3 - both')
+    rising = _read_byte(stack, I2C_MEM_DRY_CONTACT_RISING_ENABLE)
+    falling = _read_byte(stack, I2C_MEM_DRY_CONTACT_FALLING_ENABLE)
+    if edge == 0:
+        rising &= ~(1 << (ch - 1))
+        falling &= ~(1 << (ch - 1))
+    else:
+        if edge & 1:
+            rising |= 1 << (ch - 1)
+        if edge & 2:
+            falling |= 1 << (ch - 1)
+    _write_byte(stack, I2C_MEM_DRY_CONTACT_RISING_ENABLE, rising & 0xff)
+    _write_byte(stack, I2C_MEM_DRY_CONTACT_FALLING_ENABLE, falling & 0xff)
+
+
+def getInVolt(stack):
+    return _read_word(stack, DIAG_24V_MEM_ADD) / 1000.0
+
+
+def getRaspVolt(stack):
+    return _read_word(stack, DIAG_5V_MEM_ADD) / 1000.0
+
+
+def getCpuTemp(stack):
+    return _read_byte(stack, DIAG_TEMPERATURE_MEM_ADD)
+
+
+def wdtGetPeriod(stack):
+    return _read_word(stack, I2C_MEM_WDT_INTERVAL_GET_ADD)
+
+
+def wdtSetPeriod(stack, val):
+    if val < 10 or val > 65000:
+        raise ValueError('Invalid interval value [10..65000]')
+    _write_word(stack, I2C_MEM_WDT_INTERVAL_SET_ADD, val)
+    return 1
+
+
+def wdtReload(stack):
+    _write_byte(stack, I2C_MEM_WDT_RESET_ADD, RELOAD_KEY)
+    return 1
+
+
+def wdtSetDefaultPeriod(stack, val):
+    if val < 10 or val > 64999:
+        raise ValueError('Invalid interval value [10..64999]')
+    _write_word(stack, I2C_MEM_WDT_INIT_INTERVAL_SET_ADD, val)
+    return 1
+
+
+def wdtGetDefaultPeriod(stack):
+    return _read_word(stack, I2C_MEM_WDT_INIT_INTERVAL_GET_ADD)
+
+
+def wdtSetOffInterval(stack, val):
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        bus.write_i2c_block_data(HW_ADD + stack, I2C_MEM_WDT_POWER_OFF_INTERVAL_SET_ADD, list(val.to_bytes(4, 'little')))
+    return 1
+
+
+def wdtGetOffInterval(stack):
+    checkStack(stack)
+    with smbus2.SMBus(BUS_NO) as bus:
+        return int.from_bytes(bytes(bus.read_i2c_block_data(HW_ADD + stack, I2C_MEM_WDT_POWER_OFF_INTERVAL_GET_ADD, 4)), 'little')
+
+
+def wdtGetResetCount(stack):
+    return _read_word(stack, I2C_MEM_WDT_RESET_COUNT_ADD)
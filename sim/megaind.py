@@ -0,0 +1,243 @@
+"""Simulated megaind driver, API compatible with the Sequent Microsystems SMmegaind library."""
+
+import smbus2
+
+BUS_NO = 1
+HW_ADD_BASE = 0x50
+
+I2C_MEM_RELAY_VAL = 0
+I2C_MEM_RELAY_SET = 1
+I2C_MEM_RELAY_CLR = 2
+I2C_MEM_OPTO_IN_VAL = 3
+U_0_10_OUT_VAL1_ADD = 4
+I4_20_OUT_VAL1_ADD = 12
+I2C_MEM_OD_PWM1 = 20
+U0_10_IN_VAL1_ADD = 28
+U_PM_10_IN_VAL1_ADD = 36
+I4_20_IN_VAL1_ADD = 44
+I2C_MEM_WDT_RESET_ADD = 83
+I2C_MEM_WDT_INTERVAL_SET_ADD = 84
+I2C_MEM_WDT_INTERVAL_GET_ADD = 86
+I2C_MEM_WDT_INIT_INTERVAL_SET_ADD = 88
+I2C_MEM_WDT_INIT_INTERVAL_GET_ADD = 90
+I2C_MEM_WDT_RESET_COUNT_ADD = 92
+I2C_MEM_WDT_POWER_OFF_INTERVAL_SET_ADD = 95
+I2C_MEM_WDT_POWER_OFF_INTERVAL_GET_ADD = 99
+I2C_MEM_OPTO_RISING_ENABLE = 103
+I2C_MEM_OPTO_FALLING_ENABLE = 104
+I2C_MEM_OPTO_CH_CONT_RESET = 105
+I2C_MEM_OPTO_COUNT1 = 106
+I2C_MEM_DIAG_TEMPERATURE = 114
+I2C_MEM_DIAG_24V = 115
+I2C_MEM_DIAG_5V = 117
+I2C_MEM_REVISION_MAJOR = 120
+I2C_MEM_REVISION_MINOR = 121
+RELOAD_KEY = 202
+
+
+def checkStack(stack):
+    if stack < 0 or stack > 7:
+        raise ValueError('Invalid stack level!')
+    return HW_ADD_BASE + stack
+
+
+def checkChannel(ch, limit=4):
+    if ch < 1 or ch > limit:
+        raise ValueError('Invalid channel number!')
+
+
+def _read_byte(stack, register):
+    with smbus2.SMBus(BUS_NO) as bus:
+        return bus.read_byte_data(checkStack(stack), register)
+
+
+def _write_byte(stack, register, value):
+    with smbus2.SMBus(BUS_NO) as bus:
+        bus.write_byte_data(checkStack(stack), register, value)
+
+
+def _read_word(stack, register):
+    with smbus2.SMBus(BUS_NO) as bus:
+        return bus.read_word_data(checkStack(stack), register)
+
+
+def _write_word(stack, register, value):
+    with smbus2.SMBus(BUS_NO) as bus:
+        bus.write_word_data(checkStack(stack), register, value)
+
+
+def _get_bit(stack, register, bit):
+    return 1 if _read_byte(stack, register) & (1 << bit) else 0
+
+
+def _set_bit(stack, register, bit, state):
+    value = _read_byte(stack, register)
+    if state:
+        value |= 1 << bit
+    else:
+        value &= ~(1 << bit)
+    _write_byte(stack, register, value & 0xff)
+
+
+def getFwVer(stack):
+    return _read_byte(stack, I2C_MEM_REVISION_MAJOR) + _read_byte(stack, I2C_MEM_REVISION_MINOR) / 100.0
+
+
+def getRaspVolt(stack):
+    return _read_word(stack, I2C_MEM_DIAG_5V) / 1000.0
+
+
+def getPowerVolt(stack):
+    return _read_word(stack, I2C_MEM_DIAG_24V) / 1000.0
+
+
+def getCpuTemp(stack):
+    return _read_byte(stack, I2C_MEM_DIAG_TEMPERATURE)
+
+
+def get0_10In(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, U0_10_IN_VAL1_ADD + 2 * (channel - 1)) / 1000.0
+
+
+def getpm10In(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, U_PM_10_IN_VAL1_ADD + 2 * (channel - 1)) / 1000.0 - 10
+
+
+def get0_10Out(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, U_0_10_OUT_VAL1_ADD + 2 * (channel - 1)) / 1000.0
+
+
+def set0_10Out(stack, channel, value):
+    checkChannel(channel)
+    if value < 0 or value > 10:
+        raise ValueError("Invalid value!")
+    _write_word(stack, U_0_10_OUT_VAL1_ADD + 2 * (channel - 1), int(value * 1000))
+
+
+def get4_20In(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, I4_20_IN_VAL1_ADD + 2 * (channel - 1)) / 1000.0
+
+
+def get4_20Out(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, I4_20_OUT_VAL1_ADD + 2 * (channel - 1)) / 1000.0
+
+
+def set4_20Out(stack, channel, value):
+    checkChannel(channel)
+    if value < 0 or value > 20:
+        raise ValueError("Invalid value!")
+    _write_word(stack, I4_20_OUT_VAL1_ADD + 2 * (channel - 1), int(value * 1000))
+
+
+def getOptoCh(stack, channel):
+    checkChannel(channel)
+    return _get_bit(stack, I2C_MEM_OPTO_IN_VAL, channel - 1)
+
+
+def getOpto(stack):
+    return _read_byte(stack, I2C_MEM_OPTO_IN_VAL)
+
+
+def getOptoCount(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, I2C_MEM_OPTO_COUNT1 + 2 * (channel - 1))
+
+
+def rstOptoCount(stack, channel):
+    checkChannel(channel)
+    _write_byte(stack, I2C_MEM_OPTO_CH_CONT_RESET, int(channel))
+
+
+def getOptoRisingCountEnable(stack, channel):
+    checkChannel(channel)
+    return _get_bit(stack, I2C_MEM_OPTO_RISING_ENABLE, channel - 1)
+
+
+def setOptoRisingCountEnable(stack, channel, state):
+    checkChannel(channel)
+    _set_bit(stack, I2C_MEM_OPTO_RISING_ENABLE, channel - 1, state)
+
+
+def getOptoFallingCountEnable(stack, channel):
+    checkChannel(channel)
+    return _get_bit(stack, I2C_MEM_OPTO_FALLING_ENABLE, channel - 1)
+
+
+def setOptoFallingCountEnable(stack, channel, state):
+    checkChannel(channel)
+    _set_bit(stack, I2C_MEM_OPTO_FALLING_ENABLE, channel - 1, state)
+
+
+def setOdPWM(stack, channel, value):
+    checkChannel(channel)
+    if value < 0 or value > 100:
+        raise ValueError("Invalid value!")
+    _write_word(stack, I2C_MEM_OD_PWM1 + 2 * (channel - 1), int(value * 100))
+
+
+def getOdPWM(stack, channel):
+    checkChannel(channel)
+    return _read_word(stack, I2C_MEM_OD_PWM1 + 2 * (channel - 1)) / 100.0
+
+
+def setLed(stack, channel, val):
+    checkChannel(channel)
+    _write_byte(stack, I2C_MEM_RELAY_SET if val != 0 else I2C_MEM_RELAY_CLR, channel + 4)
+
+
+def setLedAll(stack, val):
+    if val < 0 or val > 15:
+        raise ValueError("Invalid value!")
+    _write_byte(stack, I2C_MEM_RELAY_VAL, val << 4)
+
+
+def getLed(stack, channel):
+    checkChannel(channel)
+    return _get_bit(stack, I2C_MEM_RELAY_VAL, channel + 3)
+
+
+def wdtGetPeriod(stack):
+    return _read_word(stack, I2C_MEM_WDT_INTERVAL_GET_ADD)
+
+
+def wdtSetPeriod(stack, val):
+    if val < 10 or val > 65000:
+        raise ValueError('Invalid interval value [10..65000]')
+    _write_word(stack, I2C_MEM_WDT_INTERVAL_SET_ADD, val)
+    return 1
+
+
+def wdtReload(stack):
+    _write_byte(stack, I2C_MEM_WDT_RESET_ADD, RELOAD_KEY)
+    return 1
+
+
+def wdtSetDefaultPeriod(stack, val):
+    if val < 10 or val > 64999:
+        raise ValueError('Invalid interval value [10..64999]')
+    _write_word(stack, I2C_MEM_WDT_INIT_INTERVAL_SET_ADD, val)
+    return 1
+
+
+def wdtGetDefaultPeriod(stack):
+    return _read_word(stack, I2C_MEM_WDT_INIT_INTERVAL_GET_ADD)
+
+
+def wdtSetOffInterval(stack, val):
+    with smbus2.SMBus(BUS_NO) as bus:
+        bus.write_i2c_block_data(checkStack(stack), I2C_MEM_WDT_POWER_OFF_INTERVAL_SET_ADD, list(val.to_bytes(4, 'little')))
+    return 1
+
+
+def wdtGetOffInterval(stack):
+    with smbus2.SMBus(BUS_NO) as bus:
+        return int.from_bytes(bytes(bus.read_i2c_block_data(checkStack(stack), I2C_MEM_WDT_POWER_OFF_INTERVAL_GET_ADD, 4)), 'little')
+
+
+def wdtGetResetCount(stack):
+    return _read_word(stack, I2C_MEM_WDT_RESET_COUNT_ADD)
@@ -0,0 +1,312 @@
+"""Simulated I2C bus shared by the simulated Sequent Microsystems card drivers.
+
+Every configured card is a 256 byte register file living on a (bus, address)
+pair. Transactions are serialized per bus and cost LATENCY seconds plus
+BYTE_TIME seconds per transferred byte, which mimics a 100 kHz I2C bus.
+Inputs are generated on every read from scripted waveforms, outputs are
+stored as written, so drivers can read back what they set.
+
+Configuration is taken from the [CARDS] and optional [SIMULATION] sections
+of the bridge config file (SIM_CONFIG environment variable or config.ini):
+
+    [SIMULATION]
+    LATENCY = 0.0003
+    BYTE_TIME = 0.00009
+    SCRIPT = waves.json
+
+The SCRIPT json maps "<card>/<stack>/<io>/<signal>/<channel>" keys to
+waveforms, e.g. {"megabas/0/input/0_10/3": {"wave": "sine", "offset": 5,
+"amplitude": 2, "period": 60, "noise": 0.005}}, and optional
+"<card>/<stack>" keys to {"fault": 0.01} transaction failure probability.
+Supported waves are const, sine, square, ramp and pulse (counter input with
+"rate" pulses per second).
+"""
+
+import configparser
+import json
+import math
+import os
+import random
+import re
+import struct
+import threading
+import time
+
+LATENCY = 0.0003
+BYTE_TIME = 0.00009
+BUS_DEFAULT = 1
+
+devices = {}
+locks = {}
+start = time.monotonic()
+stats = { "transactions": 0, "bytes": 0, "errors": 0 }
+
+
+def wave(spec, now):
+    kind = spec.get("wave", "const")
+    offset = spec.get("offset", 0.0)
+    amplitude = spec.get("amplitude", 0.0)
+    period = spec.get("period", 1.0)
+    phase = spec.get("phase", 0.0)
+    if kind == "sine":
+        value = offset + amplitude * math.sin(2 * math.pi * (now / period + phase))
+    elif kind == "square":
+        value = offset + (amplitude if (now / period + phase) % 1.0 < 0.5 else 0.0)
+    elif kind == "ramp":
+        value = offset + amplitude * ((now / period + phase) % 1.0)
+    else:
+        value = offset
+    noise = spec.get("noise", 0.0)
+    if noise:
+        value += random.gauss(0.0, noise)
+    return value
+
+
+def pulses(spec, now):
+    # number of rising edges of a pulse train since simulation start
+    rate = spec.get("rate", 0.0)
+    return int(now * rate)
+
+
+class Card:
+    name = None
+    channels = {}
+    defaults = {}
+
+    def __init__(self, stack, script):
+        self.stack = stack
+        self.memory = bytearray(256)
+        self.waves = {}
+        prefix = self.name + "/" + str(stack) + "/"
+        for key, channels in self.channels.items():
+            for channel in range(1, channels + 1):
+                spec = dict(self.defaults.get(key, {}))
+                if "phase" not in spec:
+                    spec["phase"] = channel / 10.0
+                spec.update(script.get(prefix + key + "/" + str(channel), {}))
+                self.waves[(key, channel)] = spec
+        self.fault = script.get(prefix.rstrip("/"), {}).get("fault", 0.0)
+        self.setup()
+
+    def setup(self):
+        pass
+
+    def value(self, key, channel, now):
+        return wave(self.waves[(key, channel)], now)
+
+    def refresh(self, now):
+        pass
+
+    def read(self, register, length):
+        self.refresh(time.monotonic() - start)
+        return list(self.memory[register:register + length])
+
+    def write(self, register, data):
+        self.memory[register:register + len(data)] = bytes(data)
+
+    def set_word(self, register, value, signed=False):
+        value = int(round(value))
+        if signed:
+            value = max(-32768, min(32767, value)) & 0xffff
+        else:
+            value = max(0, min(65535, value))
+        self.memory[register] = value & 0xff
+        self.memory[register + 1] = value >> 8
+
+    def get_word(self, register):
+        return self.memory[register] + (self.memory[register + 1] << 8)
+
+    def set_bits(self, register, key, count, now):
+        mask = 0
+        for channel in range(1, count + 1):
+            if self.value(key, channel, now) >= 0.5:
+                mask |= 1 << (channel - 1)
+        self.memory[register] = mask
+
+
+class Megaind(Card):
+    name = "megaind"
+    channels = { "input/0_10": 4, "input/pm0_10": 4, "input/4_20": 4, "input/opto": 4, "input/opto_count": 4 }
+    defaults = {
+        "input/0_10": { "offset": 5.0, "noise": 0.003 },
+        "input/pm0_10": { "offset": 0.0, "noise": 0.003 },
+        "input/4_20": { "offset": 12.0, "noise": 0.01 },
+        "input/opto": { "wave": "square", "amplitude": 1.0, "period": 7.0 },
+        "input/opto_count": { "rate": 0.0 },
+    }
+
+    def setup(self):
+        self.counts = [ 0, 0, 0, 0 ]
+        self.pulses = [ 0, 0, 0, 0 ]
+        self.memory[114] = 42
+        self.set_word(115, 24000)
+        self.set_word(117, 5100)
+        self.memory[120] = 1
+        self.memory[121] = 7
+        self.set_word(86, 120)
+        self.set_word(90, 300)
+        self.memory[99:103] = struct.pack('<I', 10)
+
+    def refresh(self, now):
+        for channel in range(1, 5):
+            register = 2 * (channel - 1)
+            self.set_word(28 + register, self.value("input/0_10", channel, now) * 1000)
+            self.set_word(36 + register, (self.value("input/pm0_10", channel, now) + 10) * 1000)
+            self.set_word(44 + register, self.value("input/4_20", channel, now) * 1000)
+            total = pulses(self.waves[("input/opto_count", channel)], now)
+            if self.memory[103] & (1 << (channel - 1)) or self.memory[104] & (1 << (channel - 1)):
+                self.counts[channel - 1] += total - self.pulses[channel - 1]
+            self.pulses[channel - 1] = total
+            self.set_word(106 + register, self.counts[channel - 1] & 0xffff)
+        self.set_bits(3, "input/opto", 4, now)
+
+    def write(self, register, data):
+        if register == 1:
+            self.memory[0] |= 1 << (data[0] - 1)
+        elif register == 2:
+            self.memory[0] &= ~(1 << (data[0] - 1)) & 0xff
+        elif register == 105:
+            self.counts[data[0] - 1] = 0
+        elif register == 83:
+            pass
+        elif register == 84:
+            self.memory[86:88] = bytes(data[0:2])
+        elif register == 88:
+            self.memory[90:92] = bytes(data[0:2])
+        elif register == 95:
+            self.memory[99:103] = bytes(data[0:4])
+        else:
+            Card.write(self, register, data)
+
+
+class Megabas(Card):
+    name = "megabas"
+    channels = { "input/0_10": 8, "input/1k": 8, "input/10k": 8, "input/cont": 8, "input/cont_count": 8 }
+    defaults = {
+        "input/0_10": { "offset": 5.0, "noise": 0.003 },
+        "input/1k": { "offset": 1.0, "noise": 0.002 },
+        "input/10k": { "offset": 10.0, "noise": 0.01 },
+        "input/cont": { "wave": "square", "amplitude": 1.0, "period": 9.0 },
+        "input/cont_count": { "rate": 0.0 },
+    }
+
+    def setup(self):
+        self.counts = [ 0 ] * 8
+        self.pulses = [ 0 ] * 8
+        self.set_word(0x73, 24000)
+        self.set_word(0x75, 5100)
+        self.memory[0x72] = 40
+        self.memory[0x7a] = 1
+        self.memory[0x7b] = 3
+        self.set_word(86, 120)
+        self.set_word(90, 300)
+        self.memory[99:103] = struct.pack('<I', 10)
+
+    def refresh(self, now):
+        for channel in range(1, 9):
+            register = 2 * (channel - 1)
+            self.set_word(12 + register, self.value("input/0_10", channel, now) * 1000, True)
+            self.set_word(28 + register, self.value("input/1k", channel, now) * 1000)
+            self.set_word(44 + register, self.value("input/10k", channel, now) * 1000)
+            total = pulses(self.waves[("input/cont_count", channel)], now)
+            if self.memory[103] & (1 << (channel - 1)) or self.memory[104] & (1 << (channel - 1)):
+                self.counts[channel - 1] += total - self.pulses[channel - 1]
+            self.pulses[channel - 1] = total
+            self.memory[0x80 + 4 * (channel - 1):0x84 + 4 * (channel - 1)] = struct.pack('<I', self.counts[channel - 1] & 0xffffffff)
+        self.set_bits(3, "input/cont", 8, now)
+
+    def write(self, register, data):
+        if register == 1:
+            self.memory[0] |= 1 << (data[0] - 1)
+        elif register == 2:
+            self.memory[0] &= ~(1 << (data[0] - 1)) & 0xff
+        elif register == 83:
+            pass
+        elif register == 84:
+            self.memory[86:88] = bytes(data[0:2])
+        elif register == 88:
+            self.memory[90:92] = bytes(data[0:2])
+        elif register == 95:
+            self.memory[99:103] = bytes(data[0:4])
+        else:
+            Card.write(self, register, data)
+
+
+class Relay8(Card):
+    name = "8relind"
+
+
+class Inputs8(Card):
+    name = "8inputs"
+    channels = { "input/opto": 8 }
+    defaults = { "input/opto": { "wave": "square", "amplitude": 1.0, "period": 5.0 } }
+
+    def refresh(self, now):
+        self.set_bits(0, "input/opto", 8, now)
+
+
+class Rtd(Card):
+    name = "rtd"
+    channels = { "input/rtd": 8 }
+    defaults = { "input/rtd": { "wave": "sine", "offset": 21.0, "amplitude": 0.5, "period": 600.0, "noise": 0.02 } }
+
+    def refresh(self, now):
+        for channel in range(1, 9):
+            self.memory[4 * (channel - 1):4 * channel] = struct.pack('<f', self.value("input/rtd", channel, now))
+
+
+models = {
+    "megaind": ( Megaind, lambda stack: 0x50 + stack ),
+    "megabas": ( Megabas, lambda stack: 0x48 + stack ),
+    "8relind": ( Relay8, lambda stack: 0x38 + (0x07 ^ stack) ),
+    "8inputs": ( Inputs8, lambda stack: 0x20 + (0x07 ^ stack) ),
+    "rtd": ( Rtd, lambda stack: 0x40 + stack ),
+}
+
+
+def load(path=None):
+    global LATENCY, BYTE_TIME
+    config = configparser.ConfigParser()
+    config.read(path or os.environ.get('SIM_CONFIG', 'config.ini'))
+    script = {}
+    if 'SIMULATION' in config:
+        LATENCY = float(config['SIMULATION'].get('LATENCY', LATENCY))
+        BYTE_TIME = float(config['SIMULATION'].get('BYTE_TIME', BYTE_TIME))
+        if config['SIMULATION'].get('SCRIPT'):
+            with open(config['SIMULATION']['SCRIPT']) as file:
+                script = json.load(file)
+    if 'CARDS' in config:
+        for key in config['CARDS']:
+            match = re.match(r'^(?:BUS(\d+)_)?STACK(\d+)$', key, re.IGNORECASE)
+            if match and config['CARDS'][key] in models:
+                bus = int(match.group(1)) if match.group(1) else BUS_DEFAULT
+                stack = int(match.group(2)) % 8
+                model, address = models[config['CARDS'][key]]
+                devices[(bus, address(stack))] = model(stack, script)
+
+
+def transfer(bus, address, length, action):
+    # serialize transactions per bus and account for the wire time
+    lock = locks.setdefault(bus, threading.Lock())
+    with lock:
+        stats["transactions"] += 1
+        stats["bytes"] += length
+        delay = LATENCY + BYTE_TIME * (length + 2)
+        if delay > 0:
+            time.sleep(delay)
+        device = devices.get((bus, address))
+        if device is None or (device.fault and random.random() < device.fault):
+            stats["errors"] += 1
+            raise OSError(121, 'Remote I/O error')
+        return action(device)
+
+
+def read(bus, address, register, length):
+    return transfer(bus, address, length, lambda device: device.read(register, length))
+
+
+def write(bus, address, register, data):
+    transfer(bus, address, len(data), lambda device: device.write(register, data))
+
+
+load()
@@ -0,0 +1,40 @@
+"""Simulated smbus2 module routing transactions to the simbus register files."""
+
+import simbus
+
+
+class SMBus:
+    def __init__(self, bus=None):
+        self.bus = bus if bus is not None else simbus.BUS_DEFAULT
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def read_byte_data(self, address, register):
+        return simbus.read(self.bus, address, register, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        simbus.write(self.bus, address, register, [ value & 0xff ])
+
+    def read_word_data(self, address, register):
+        data = simbus.read(self.bus, address, register, 2)
+        return data[0] + (data[1] << 8)
+
+    def write_word_data(self, address, register, value):
+        simbus.write(self.bus, address, register, [ value & 0xff, (value >> 8) & 0xff ])
+
+    def read_i2c_block_data(self, address, register, length):
+        if length > 32:
+            raise ValueError('Maximum I2C block length is 32 bytes')
+        return simbus.read(self.bus, address, register, length)
+
+    def write_i2c_block_data(self, address, register, data):
+        if len(data) > 32:
+            raise ValueError('Maximum I2C block length is 32 bytes')
+        simbus.write(self.bus, address, register, list(data))